@@ -0,0 +1,82 @@
+"""
+Compare the checkpoint of WordCounter before and after CounterMap: a HGET
+and a HSET for each distinct word, against one pipelined HINCRBY per word.
+
+    python benchmark.py --redis redis://localhost/15 --words 100000
+
+The database is flushed. Round trips are counted on the client side: with
+a remote redis each of them also costs a network round trip time.
+"""
+import argparse
+import random
+import time
+
+import redis
+import redis.connection
+from snowcat.utils.redis_utils import CounterMap
+
+round_trips = [0]
+_send = redis.connection.Connection.send_packed_command
+
+
+def _counting_send(self, command, *args, **kwargs):
+    round_trips[0] += 1
+    return _send(self, command, *args, **kwargs)
+
+
+redis.connection.Connection.send_packed_command = _counting_send
+
+
+def hget_hset(client, words, checkpoint):
+    """ The checkpoint of WordCounter before CounterMap """
+    key = 'WordCount:bench'
+    counts = {}
+    for i, word in enumerate(words, 1):
+        counts[word] = counts.get(word, 0) + 1
+        if i % checkpoint == 0 or i == len(words):
+            for k, v in counts.iteritems():
+                current = client.hget(key, k)
+                if current is None:
+                    current = 0
+                client.hset(key, k, int(current) + v)
+            counts = {}
+
+
+def counter_map(client, words, checkpoint):
+    counts = CounterMap('WordCount:bench', redis_client=client)
+    for i, word in enumerate(words, 1):
+        counts.incr(word)
+        if i % checkpoint == 0 or i == len(words):
+            counts.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--redis', default='redis://localhost/15')
+    parser.add_argument('--words', type=int, default=100000)
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--checkpoint', type=int, default=10000,
+                        help='items between two checkpoints')
+    args = parser.parse_args()
+
+    client = redis.StrictRedis.from_url(args.redis)
+    rnd = random.Random(42)
+    words = ['w{0}'.format(int(rnd.paretovariate(1.2)) % args.vocabulary)
+             for _ in xrange(args.words)]
+
+    results = {}
+    for f in (hget_hset, counter_map):
+        client.flushdb()
+        round_trips[0] = 0
+        start = time.time()
+        f(client, words, args.checkpoint)
+        elapsed = time.time() - start
+        results[f.__name__] = client.hgetall('WordCount:bench')
+        print '{0:10} {1:8.3f}s {2:8} round trips'.format(
+            f.__name__, elapsed, round_trips[0])
+    client.flushdb()
+    assert results['hget_hset'] == results['counter_map']
+
+
+if __name__ == '__main__':
+    main()
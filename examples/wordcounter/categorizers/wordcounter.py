@@ -1,4 +1,5 @@
 from snowcat.categorizers import LoopCategorizer
+from snowcat.utils.redis_utils import CounterMap
 import datetime
 
 
@@ -8,7 +9,11 @@ class WordCounter(LoopCategorizer):
     DEPENDENCIES = ['WordSplitter']
     CHECKPOINT_FREQUENCY = 10  # ten seconds
     INPUT_QUEUE = 'Words'
-    DEFAULT_S = {'words': {}}
+    FUSE = True  # runs in the task of WordSplitter
+
+    def pre_run(self, user):
+        self.words = CounterMap('WordCount:{0}'.format(user),
+                                redis_client=self.redis_for(user))
 
     def process(self, user, val, *args, **kwargs):
         # segnale inizio stream
@@ -21,16 +26,8 @@ class WordCounter(LoopCategorizer):
             with open('/tmp/snowcat_end', 'wb') as f:
                 f.write(str(datetime.datetime.now()))
 
-        current = self.s.words.get(val, 0)
-        self.s.words[val] = current + 1
+        self.words.incr(val)
 
     def checkpoint(self, user):
-        for k, v in self.s.words.iteritems():
-            current = self.redis_client.hget('WordCount:{0}'.format(user), k)
-            if current is None:
-                current = 0
-            self.redis_client.hset(
-                'WordCount:{0}'.format(user), k, int(current) + v
-            )
-
-        self.s.words = {}
+        # one pipelined HINCRBY per word instead of HGET + HSET
+        self.words.flush()
@@ -3,6 +3,7 @@ import snowcat
 from categorizers import wordsplitter, wordcounter
 
 from celery import Celery
+from datetime import timedelta
 
 celeryapp = Celery('wordcounter',
                    broker='amqp://',
@@ -14,6 +15,16 @@ celeryapp.conf.update(
     CELERY_RESULT_BACKEND='amqp',
     CELERY_IGNORE_RESULT=False,
     CELERY_TASK_RESULT_EXPIRES=3600,
+    CELERYBEAT_SCHEDULE={
+        'reap-idle-streams': {
+            'task': 'ReapIdleStreams',
+            'schedule': timedelta(minutes=5),
+        },
+        'sweep-ready': {
+            'task': 'SweepReady',
+            'schedule': timedelta(minutes=1),
+        },
+    },
 )
 
 
@@ -1,5 +1,6 @@
 from flask import Flask, request
 from snowcat.core import Topology
+from snowcat.admission import AdmissionControl, Backpressure
 from celeryapp import celeryapp
 
 app = Flask(__name__)
@@ -12,16 +13,22 @@ def process_data():
     if request.method == 'POST':  # should not be necessary, but still...
         # print data
 
-        t.add_data({
-            'user': request.form['user'],
-            'data': list(request.form['data'])  # put one char at a time
-        })
+        try:
+            t.add_data({
+                'user': request.form['user'],
+                'data': list(request.form['data'])  # put one char at a time
+            })
+        except Backpressure as e:
+            headers = {}
+            if e.retry_after is not None:
+                headers['Retry-After'] = str(e.retry_after)
+            return e.reason, 503, headers
         return 'ok'  # Too lazy to handle errors. TODO: handle errors!!
 
 
 def run_snowcat():
     global t
-    t = Topology('wordcounter', celeryapp)
+    t = Topology('wordcounter', celeryapp, admission=AdmissionControl)
 
     errors = t.errors()
 
@@ -11,6 +11,10 @@ setup(
         'msgpack-python',
         'lockfile'
     ],
+    extras_require={
+        'columnar': ['numpy'],
+        'async': ['trollius'],
+    },
     zip_safe=False,
 
     author="Marco Dallagiacoma",
@@ -0,0 +1,187 @@
+"""
+Admission control for the ingestion of new data.
+
+If the categorizers can't keep up with the incoming data, queues and state
+grow until the node runs out of disk or memory. AdmissionControl looks at
+how far behind the categorizers of a stream are, at the free disk space
+and at the memory used by redis, and decides whether new data should be:
+
+* accepted;
+* delayed: the client is asked to retry after some seconds;
+* shed: the data is dropped.
+"""
+import os
+import time
+from celery.utils.log import get_task_logger
+from categorizers import get_all_categorizers, LoopCategorizer
+from utils.fsqueue import QueueIndex
+from utils.sharding import get_redis, all_redis
+
+
+class Backpressure(RuntimeError):
+    """ Raised when new data is not admitted """
+    def __init__(self, reason, retry_after=None):
+        super(Backpressure, self).__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class DelayIngestion(Backpressure):
+    """ The client should send the data again after ``retry_after`` seconds
+    """
+    pass
+
+
+class ShedLoad(Backpressure):
+    """ The data has been dropped """
+    pass
+
+
+class AdmissionControl(object):
+    ACCEPT = 'accept'
+    DELAY = 'delay'
+    SHED = 'shed'
+
+    METRICS_KEY = 'snowcat:admission'
+
+    def __init__(self, app, fs_prefix='/tmp/snowcat/',
+                 stream_lag_delay=10000, stream_lag_shed=None,
+                 min_free_disk_delay=0.1, min_free_disk_shed=0.02,
+                 redis_memory_delay=None, redis_memory_shed=None,
+                 retry_after=5, stats_ttl=1.0):
+        """
+        :param stream_lag_delay: delay (shed) data of a stream when one of its
+         categorizers is more than this number of items behind.
+         None disables the check.
+        :param min_free_disk_delay: delay (shed) all the data when the free
+         fraction of the disk holding the queues is under this threshold.
+        :param redis_memory_delay: delay (shed) all the data when redis uses
+         more than this number of bytes.
+        :param retry_after: seconds suggested to the clients when delayed.
+        :param stats_ttl: seconds for which global stats (disk, redis memory)
+         are cached.
+        """
+        self.app = app
+        self.fs_prefix = fs_prefix
+        self.stream_lag_delay = stream_lag_delay
+        self.stream_lag_shed = stream_lag_shed
+        self.min_free_disk_delay = min_free_disk_delay
+        self.min_free_disk_shed = min_free_disk_shed
+        self.redis_memory_delay = redis_memory_delay
+        self.redis_memory_shed = redis_memory_shed
+        self.retry_after = retry_after
+        self.stats_ttl = stats_ttl
+
+        self.logger = get_task_logger('AdmissionControl')
+
+        self.metrics = {self.ACCEPT: 0, self.DELAY: 0, self.SHED: 0}
+        self._stats = None
+        self._stats_time = 0
+
+    def _consumers(self):
+        return [c for c in get_all_categorizers(self.app)
+                if isinstance(c, LoopCategorizer) and c.INPUT_QUEUE]
+
+    def stream_lag(self, auth_id):
+        """ Return the number of items the slowest categorizer of the stream
+        still has to process.
+        Categorizers which didn't run yet, or which have finished, are not
+        taken into account.
+        """
+        progress = get_redis(auth_id).hgetall('{0}:progress'.format(auth_id))
+
+        lag = 0
+        for cat in self._consumers():
+            if cat.name not in progress:
+                continue
+            written = QueueIndex(cat.queue_dir(auth_id)).total_items()
+            lag = max(lag, written - int(progress[cat.name]))
+        return lag
+
+    def global_stats(self):
+        """ Return the free fraction of the disk holding the queues and the
+        memory used by redis (cached for ``stats_ttl`` seconds).
+        """
+        expired = time.time() - self._stats_time > self.stats_ttl
+        if self._stats is None or expired:
+            free_disk = None
+            if self.min_free_disk_delay or self.min_free_disk_shed:
+                path = self.fs_prefix
+                while not os.path.exists(path):
+                    path = os.path.dirname(path.rstrip('/')) or '/'
+                st = os.statvfs(path)
+                free_disk = float(st.f_bavail) / (st.f_blocks or 1)
+
+            redis_memory = None
+            if self.redis_memory_delay or self.redis_memory_shed:
+                redis_memory = max(r.info('memory')['used_memory']
+                                   for r in all_redis())
+
+            self._stats = {'free_disk': free_disk,
+                           'redis_memory': redis_memory}
+            self._stats_time = time.time()
+        return self._stats
+
+    def global_metrics(self):
+        """ Return the decisions taken by all the nodes """
+        res = {self.ACCEPT: 0, self.DELAY: 0, self.SHED: 0}
+        for r in all_redis():
+            for k, v in r.hgetall(self.METRICS_KEY).iteritems():
+                res[k] = res.get(k, 0) + int(v)
+        return res
+
+    def _over(self, value, threshold, below=False):
+        if value is None or threshold is None:
+            return False
+        return value < threshold if below else value > threshold
+
+    def check(self, auth_id, shed_only=False):
+        """ Return (decision, reason) for new data of stream ``auth_id``.
+        :param shed_only: only checks that can shed the data are done.
+        """
+        stats = self.global_stats()
+        lag = None
+        if self.stream_lag_shed is not None or \
+                (self.stream_lag_delay is not None and not shed_only):
+            lag = self.stream_lag(auth_id)
+
+        checks = [
+            ('free disk', stats['free_disk'],
+             self.min_free_disk_delay, self.min_free_disk_shed, True),
+            ('redis memory', stats['redis_memory'],
+             self.redis_memory_delay, self.redis_memory_shed, False),
+            ('stream lag', lag,
+             self.stream_lag_delay, self.stream_lag_shed, False),
+        ]
+
+        decision, reason = self.ACCEPT, None
+        for name, value, delay, shed, below in checks:
+            if self._over(value, shed, below):
+                return self.SHED, '{0} is {1}'.format(name, value)
+            if self._over(value, delay, below) and decision == self.ACCEPT:
+                decision, reason = self.DELAY, '{0} is {1}'.format(name, value)
+        return decision, reason
+
+    def admit(self, auth_id, shed_only=False):
+        """ Raise DelayIngestion or ShedLoad if new data for the stream
+        should not be accepted.
+        :param shed_only: only raise ShedLoad (i.e. when the data can't be
+         sent back to the client).
+        """
+        decision, reason = self.check(auth_id, shed_only)
+        if shed_only and decision == self.DELAY:
+            decision = self.ACCEPT
+
+        # with many redis nodes the metrics are spread over them (see
+        # global_metrics)
+        self.metrics[decision] += 1
+        get_redis(auth_id).hincrby(self.METRICS_KEY, decision, 1)
+
+        if decision == self.DELAY:
+            self.logger.info('delaying data of {0}: {1}'
+                             .format(auth_id, reason))
+            raise DelayIngestion(reason, self.retry_after)
+        if decision == self.SHED:
+            self.logger.warning('shedding data of {0}: {1}'
+                                .format(auth_id, reason))
+            raise ShedLoad(reason)
@@ -0,0 +1,269 @@
+"""
+Categorizers multiplexing many streams on an event loop.
+
+A LoopCategorizer keeps a celery worker slot busy for the whole run on a
+stream, even when it is just waiting for redis or for the file system.
+AsyncLoopCategorizer.run only schedules the stream on an event loop, which
+runs in a background thread of the worker process and drives the loops of
+all the streams of the process: the celery slot is freed immediately.
+
+Blocking calls (redis, file system, celery) run in a bounded pool of I/O
+threads, so a single worker process can serve thousands of mostly idle
+streams. ``process`` runs on the event loop thread and must not block.
+
+Requires trollius (the asyncio port which also runs on python 2).
+"""
+import os
+import threading
+import time
+
+import trollius as asyncio
+from trollius import From, Return
+from concurrent.futures import ThreadPoolExecutor
+
+from categorizers import LoopCategorizer, initialize_categorizers
+from decorators import LOCK_EXPIRE, report_run
+from utils import columnar
+from utils.redis_utils import SimpleKV
+
+
+class _Runtime(object):
+    """ The event loop of a worker process, and its I/O threads """
+    def __init__(self, io_threads):
+        self.pid = os.getpid()
+        self.running = set()
+        self.executor = ThreadPoolExecutor(io_threads)
+        self.loop = asyncio.new_event_loop()
+
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name='snowcat-event-loop')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+def get_runtime(io_threads=16):
+    """ Return the event loop runtime of this process, starting it if needed.
+    Runtimes are not inherited by forked processes (i.e. celery prefork
+    children): each one starts its own.
+    """
+    global _runtime
+    with _runtime_lock:
+        if _runtime is None or _runtime.pid != os.getpid():
+            _runtime = _Runtime(io_threads)
+        return _runtime
+
+
+class _StreamContext(object):
+    """ Per stream state, which LoopCategorizer keeps in the task itself """
+    def __init__(self, auth_id):
+        self.auth_id = auth_id
+        self.s = None
+        self.kv = None
+        self.windows = None
+        self.prefetcher = None
+        self.emitter = None
+
+
+def _ctx_property(attr):
+    def getter(self):
+        ctx = self._context()
+        return getattr(ctx, attr) if ctx is not None else None
+
+    def setter(self, value):
+        ctx = self._context()
+        if ctx is not None:
+            setattr(ctx, attr, value)
+
+    return property(getter, setter)
+
+
+class AsyncLoopCategorizer(LoopCategorizer):
+    """
+    A LoopCategorizer whose streams are multiplexed on the event loop of the
+    worker process. It is used exactly like a LoopCategorizer: ``self.s``,
+    ``self.kv`` and windows refer to the stream being processed, and
+    locking, initialization and finalization work the same way.
+    """
+    abstract = True
+
+    IO_THREADS = 16
+    # number of items processed before giving the other streams a chance
+    YIELD_EVERY = 100
+    # streams are already multiplexed on the event loop
+    COALESCE = 0
+
+    # self.s, self.kv and self._windows depend on the stream being
+    # processed by the current thread (the event loop or an I/O thread).
+    _local = threading.local()
+    s = _ctx_property('s')
+    kv = _ctx_property('kv')
+    _windows = _ctx_property('windows')
+    _prefetcher = _ctx_property('prefetcher')
+    _emitter = _ctx_property('emitter')
+
+    def _context(self):
+        return getattr(self._local, self.name, None)
+
+    def _activate(self, ctx):
+        setattr(self._local, self.name, ctx)
+
+    def _io(self, fn, *args):
+        """ Run a blocking function in the I/O threads """
+        rt = get_runtime(self.IO_THREADS)
+        return rt.loop.run_in_executor(rt.executor, fn, *args)
+
+    def _io_ctx(self, ctx, fn, *args):
+        """ Run a blocking method with the context of a stream activated """
+        def call():
+            self._activate(ctx)
+            try:
+                return fn(*args)
+            finally:
+                self._activate(None)
+        return self._io(call)
+
+    def run(self, auth_id):
+        """ Schedule the stream on the event loop and return immediately """
+        rt = get_runtime(self.IO_THREADS)
+        rt.loop.call_soon_threadsafe(self._schedule, rt, auth_id)
+        return True
+
+    def _schedule(self, rt, auth_id):
+        key = (self.name, auth_id)
+        if key in rt.running:  # already running in this process
+            return
+        rt.running.add(key)
+
+        task = getattr(asyncio, 'ensure_future', None) or \
+            getattr(asyncio, 'async')
+        future = task(self.run_stream(auth_id), loop=rt.loop)
+        future.add_done_callback(lambda f: rt.running.discard(key))
+
+    @asyncio.coroutine
+    def run_stream(self, auth_id):
+        """ Coroutine equivalent of the singleton LoopCategorizer.run.
+        Runs are not profiled (see snowcat.profiling).
+        """
+        redis_client = self.redis_for(auth_id)
+        lock = redis_client.lock(self.gen_key(auth_id, 'lock'),
+                                 timeout=LOCK_EXPIRE, thread_local=False)
+        have_lock = yield From(self._io(lock.acquire, False))
+
+        # if the categorizer has already finished, return immediately
+        finished = yield From(self._io(redis_client.get,
+                                       '{0}:finished'.format(auth_id)))
+        if finished or not have_lock:
+            if have_lock:
+                yield From(self._io(lock.release))
+            raise Return(False)
+
+        ctx = _StreamContext(auth_id)
+        try:
+            with report_run(self, auth_id, lambda: ctx.s):
+                yield From(self._loop(ctx, auth_id))
+        finally:
+            yield From(self._io(lock.release))
+        raise Return(True)
+
+    def _buffered(self, ctx, _idx):
+        """ Return the <_idx>-th item if it is in the buffer, without I/O """
+        buf, offset = ctx.s.cat__buf, ctx.s.cat__buf_offset
+        if buf is None or offset is None or columnar.is_columnar(buf):
+            return None
+        if 0 <= _idx - offset < len(buf):
+            return buf[_idx - offset]
+        return None
+
+    @asyncio.coroutine
+    def _loop(self, ctx, auth_id):
+        # launch categorizers initialization, if it hasn't been done already.
+        yield From(self._io(initialize_categorizers, self.app, auth_id))
+
+        # if the categorizer is not active, just call his children
+        active = yield From(self._io(self.is_active, auth_id))
+        if not active:
+            if self.CALL_CHILDREN:
+                yield From(self._io(self.call_children, auth_id))
+            return
+
+        # if the categorizer has already processed its stream, don't start it
+        finished = yield From(self._io(self.has_finished, auth_id, self.name))
+        if finished:
+            self.logger.debug('Already finished, stopping now.')
+            return
+
+        ctx.kv = SimpleKV(auth_id)
+        ctx.s = yield From(self._io(self.load_state, auth_id))
+        ctx.s.loop = True
+        ctx.windows = {}
+        ctx.prefetcher = self.start_prefetch(auth_id)
+        self._activate(ctx)
+        try:
+            ctx.emitter = self.start_emitter(auth_id)
+        finally:
+            self._activate(None)
+        try:
+            yield From(self._run_items(ctx, auth_id))
+        finally:
+            if ctx.prefetcher is not None:
+                ctx.prefetcher.close()
+
+    @asyncio.coroutine
+    def _run_items(self, ctx, auth_id):
+        yield From(self._io_ctx(ctx, self.pre_run, auth_id))
+
+        processed = 0
+        while ctx.s.loop:
+            if self.COLUMNAR:
+                item = yield From(self._io_ctx(ctx, self.bufget_batch,
+                                               auth_id, ctx.s.idx))
+            else:
+                item = self._buffered(ctx, ctx.s.idx)
+                if item is None:  # the buffer must be filled
+                    item = yield From(self._io_ctx(ctx, self.bufget,
+                                                   auth_id, ctx.s.idx))
+
+            time_since_last_save = time.time() - ctx.s.last_save
+
+            if item is None or time_since_last_save > self.CHECKPOINT_FREQUENCY:
+                yield From(self._io_ctx(ctx, self.checkpoint, auth_id))
+                yield From(self._io_ctx(ctx, self.commit, auth_id))
+                ctx.s.last_save = time.time()
+
+                if self.CALL_CHILDREN:
+                    yield From(self._io(self.call_children, auth_id))
+
+            if item is None:
+                break
+
+            self._activate(ctx)
+            try:
+                if self.COLUMNAR:
+                    self.process_batch(auth_id, item)
+                    ctx.s.idx += len(item.itervalues().next())
+                else:
+                    self.process(auth_id, item)
+                    ctx.s.idx += 1
+            finally:
+                self._activate(None)
+
+            processed += 1
+            if not processed % self.YIELD_EVERY:
+                yield From(asyncio.sleep(0))
+
+        yield From(self._io(ctx.emitter.flush))
+        yield From(self._io(ctx.s.save))
+
+        yield From(self._io_ctx(ctx, self.post_run, auth_id))
+
+        if ctx.s.loop:
+            # check if new data has been added in the meantime
+            item = yield From(self._io_ctx(ctx, self.bufget,
+                                           auth_id, ctx.s.idx))
+            if item is not None:
+                yield From(self._io(lambda: self.apply_async(
+                    countdown=2, args=(auth_id,))))
@@ -2,13 +2,15 @@ from abc import abstractmethod
 from celery import Task
 from celery.canvas import chain
 from celery.utils.log import get_task_logger
-import msgpack
 from utils.redis_utils import PersistentObject, SimpleKV
-from decorators import singleton_task
-from lockfile import LockFile
+from utils.statestore import SpillableObject
+from utils import columnar, fsqueue
+from utils.sharding import get_redis
+from decorators import singleton_task, report_run, LOCK_EXPIRE
+from profiling import PROFILE_KEY, profile_run
 import time
 import os
-import redis
+import uuid
 
 
 def get_stream_finalizers(celeryapp):
@@ -57,6 +59,54 @@ def get_categorizer_by_name(celeryapp, name):
     raise IndexError('{0} is not a valid categorizer name'.format(name))
 
 
+def fusion_error(celeryapp, categorizer):
+    """
+    Return the reason why the categorizer can't be run in the task of its
+    parent (see LoopCategorizer.FUSE), or None if it can.
+    """
+    def loop_run(cat):
+        return isinstance(cat, LoopCategorizer) and \
+            type(cat).run.im_func is LoopCategorizer.run.im_func
+
+    if not loop_run(categorizer):
+        return 'only LoopCategorizers can be fused'
+    if not categorizer.INPUT_QUEUE:
+        return 'no INPUT_QUEUE'
+    if len(categorizer.DEPENDENCIES) != 1:
+        return 'it must depend on exactly one categorizer'
+
+    try:
+        parent = get_categorizer_by_name(celeryapp,
+                                         categorizer.DEPENDENCIES[0])
+    except IndexError as e:
+        return str(e)
+    if not loop_run(parent):
+        return 'its parent {0} is not a LoopCategorizer'.format(parent.name)
+    if categorizer.COLUMNAR or parent.COLUMNAR:
+        return 'columnar categorizers can\'t be fused'
+    # spilled states are saved to sqlite, outside the redis transaction
+    # which commits the fused states together
+    if categorizer.SPILL_STATE or parent.SPILL_STATE:
+        return 'categorizers with SPILL_STATE can\'t be fused'
+
+    for cat in get_all_categorizers(celeryapp):
+        if cat is not categorizer and \
+                getattr(cat, 'INPUT_QUEUE', None) == categorizer.INPUT_QUEUE:
+            return 'queue {0} is also read by {1}'.format(
+                categorizer.INPUT_QUEUE, cat.name)
+    return None
+
+
+# release many locks at once, if they still hold the given tokens
+_RELEASE_LOCKS_LUA = """
+for i, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[i] then
+        redis.call('DEL', key)
+    end
+end
+"""
+
+
 def initialize_categorizers(celeryapp, auth_id):
     """
     Initialize all the categorizers recursively starting from
@@ -102,7 +152,14 @@ class Categorizer(Task):
 
     DEPENDENCIES = []
 
-    redis_client = redis.StrictRedis()
+    @property
+    def redis_client(self):
+        """ Client of the first redis node, for global keys """
+        return get_redis()
+
+    def redis_for(self, auth_id):
+        """ Client of the redis node holding the keys of a stream """
+        return get_redis(auth_id)
 
     @property
     def logger(self):
@@ -181,16 +238,17 @@ class Categorizer(Task):
         """ Return True if the categorizer is running """
         lock_key = self.gen_key(user, 'lock')
 
-        if self.redis_client.get(lock_key) is None:
+        if self.redis_for(user).get(lock_key) is None:
             return False
         return True
 
     def has_finished(self, auth_id, categorizer=None):
-        if self.redis_client.exists('{0}:finished'.format(auth_id)):
+        redis_client = self.redis_for(auth_id)
+        if redis_client.exists('{0}:finished'.format(auth_id)):
             return True
 
         if categorizer is not None:
-            return self.redis_client.sismember(
+            return redis_client.sismember(
                 '{0}:finished_tasks'.format(auth_id), categorizer)
 
     def run_if_not_already_running(self, user, *args, **kwargs):
@@ -206,10 +264,11 @@ class Categorizer(Task):
          cleanup. If False the cleanup has to be managed expressly.
         :return: True if all the other tasks finished, False otherwise.
         """
-        p = self.redis_client.pipeline()
+        p = self.redis_for(user).pipeline()
         k = '{0}:finished_tasks'.format(user)
         p.sadd(k, self.name)
         p.smembers(k)
+        p.hdel(self.shared_key(user, 'progress'), self.name)
         finished_tasks = p.execute()[1]
 
         if cleanup:
@@ -229,18 +288,19 @@ class Categorizer(Task):
         if self.debug:
             return
 
+        redis_client = self.redis_for(user)
         keys = []
         cursor, first = 0, True
         while int(cursor) != 0 or first:
             first = False
-            cursor, data = self.redis_client.scan(
+            cursor, data = redis_client.scan(
                 cursor,
                 match='{0}:*'.format(self.gen_key(user))
             )
             keys.extend([d for d in data if not d.endswith(':lock')])
 
         if keys:
-            self.redis_client.delete(*keys)
+            redis_client.delete(*keys)
 
     def finalize_stream(self, auth_id):
         """ Launch the stream finalizer tasks for this stream.
@@ -267,6 +327,60 @@ class LoopCategorizer(Categorizer):
 
     BUFFER_LENGTH = 10
 
+    # schema of the input queue, as a list of (field name, numpy dtype).
+    # If COLUMNAR is True, the categorizer receives whole chunks as numpy
+    # arrays in process_batch; row chunks are converted using INPUT_SCHEMA.
+    INPUT_SCHEMA = None
+    COLUMNAR = False
+
+    # if True, input chunks are taken from the chunk cache shared with the
+    # other categorizers of the worker. Items are read only (lists become
+    # tuples and dicts FrozenDicts).
+    SHARED_INPUT = False
+
+    # number of input chunks loaded in advance by a background thread
+    # while the current one is processed (0 disables prefetching)
+    PREFETCH_DEPTH = 0
+
+    # items passed to emit() are written in chunks of EMIT_CHUNK_SIZE items,
+    # or at checkpoint. If EMIT_FSYNC is True chunks are synced to disk.
+    EMIT_CHUNK_SIZE = 1000
+    EMIT_FSYNC = False
+
+    # if True, the categorizer runs in the task of its parent (its only
+    # dependency): the items emitted by the parent to INPUT_QUEUE are passed
+    # to process directly, without writing them to the queue, and the states
+    # of both are committed together at the checkpoints of the parent.
+    # The parent should write INPUT_QUEUE with emit only, otherwise items
+    # may be processed out of order. See fusion_error for the requirements.
+    FUSE = False
+
+    # attributes of DEFAULT_S (dicts) which may grow too large to be kept in
+    # memory: at most SPILL_MAX_ITEMS items of each are kept in memory, the
+    # others in a sqlite database next to the queues of the stream, where
+    # the whole state is saved (see snowcat.utils.statestore).
+    SPILL_STATE = ()
+    SPILL_MAX_ITEMS = 100000
+
+    # if > 0, streams with new data don't get a task each: they are marked
+    # as ready, and a RunCoalesced task (see snowcat.tasks) runs the
+    # categorizer on up to COALESCE of them in turn, loading their locks and
+    # states and committing them with a few pipelined round trips.
+    # The task starts COALESCE_DELAY seconds after the first stream is
+    # marked, so that other streams can join the batch.
+    # Fused children (see FUSE) run in their own tasks in coalesced runs.
+    # Schedule SweepReady with celery beat, so that ready streams are not
+    # stranded when a RunCoalesced task is lost.
+    COALESCE = 0
+    COALESCE_DELAY = 1
+
+    _windows = None
+    _prefetcher = None
+    _emitter = None
+    _fused = None  # input queue -> fused child categorizer
+    _fused_locks = None
+    _auth_id = None
+
     def queue_dir(self, auth_id, queue=None):
         if queue is None:
             queue = self.INPUT_QUEUE
@@ -274,74 +388,421 @@ class LoopCategorizer(Categorizer):
         return os.path.join(self.FSQUEUE_PREFIX, str(auth_id), queue, 'queue')
 
     @staticmethod
-    def save_chunk_fs(data, queue_dir):
+    def save_chunk_fs(data, queue_dir, schema=None, fsync=False):
         """ Save a chunk of data on the file system.
         Data will be serialized as messagepack.
+        If a schema is given, records are stored as a columnar chunk
+        (see snowcat.utils.columnar).
+        If fsync is True, the data is flushed to disk before returning.
         """
-        # todo: give option to set index manually
-        try:
-            ls = os.listdir(queue_dir)
-        except OSError:
-            if not os.path.exists(queue_dir):
-                os.makedirs(queue_dir)
-                ls = []
-            else:
-                return False
+        if schema is not None and data and not columnar.is_columnar(data):
+            data = columnar.from_rows(data, schema)
 
-        mx = 0
-        for s in ls:
-            try:
-                num = int(s)
-            except ValueError:
-                continue
-            mx = max(mx, num)
+        return fsqueue.append_chunk(data, queue_dir, fsync=fsync)
 
-        file_path = os.path.join(queue_dir, str(mx + 1))
-        lock = LockFile(file_path)
-        with lock, open(file_path, 'wb') as f:
-            f.write(msgpack.dumps(data))
-        return True
+    def queue_index(self, auth_id, queue=None):
+        """ Return the sparse offset index of a queue """
+        return fsqueue.QueueIndex(self.queue_dir(auth_id, queue))
 
-    def _fill_buffer(self, auth_id, chunk_num):
-        """ Fill the buffer with the data in <chunk_num>-th file.
+    def _fill_buffer(self, auth_id, chunk_num, offset=None):
+        """ Fill the buffer with the data in <chunk_num>-th file, whose first
+        item is the <offset>-th of the queue (defaults to the current index).
         Return False if the file does not exist.
         """
-        file_path = os.path.join(self.queue_dir(auth_id),
-                                 str(chunk_num))
-
-        if os.path.exists(file_path):
-            lock = LockFile(file_path)
-            with lock, open(file_path, 'rb') as f:  # todo: lock timeout
-                # if file is empty, try again with the next one
-                val = msgpack.unpack(f)
-                if not val:
-                    return self._fill_buffer(auth_id, chunk_num+1)
-
-                # fill buffer
-                self.s.cat__buf = val
-                self.s.cat__buf_offset = self.s.idx
-                self.s.cat__chunk = chunk_num
-                return True
-        return False
+        if offset is None:
+            offset = self.s.idx
+
+        if self._prefetcher is not None:
+            val = self._prefetcher.get(chunk_num)
+        else:
+            val = fsqueue.load_chunk(self.queue_dir(auth_id), chunk_num,
+                                     shared=self.SHARED_INPUT)
+        if val is None:
+            return False
 
-    def bufget(self, auth_id, _idx, rec=True):
+        # if file is empty, try again with the next one
+        if not val or not columnar.length(val):
+            return self._fill_buffer(auth_id, chunk_num+1, offset)
+
+        # convert the chunk to the format expected by the categorizer
+        if self.COLUMNAR and not columnar.is_columnar(val):
+            if self.INPUT_SCHEMA is None:
+                raise ValueError('{0} is COLUMNAR but has no INPUT_SCHEMA to '
+                                 'convert row chunks'.format(self.name))
+            val = columnar.from_rows(val, self.INPUT_SCHEMA)
+        elif not self.COLUMNAR and columnar.is_columnar(val):
+            val = columnar.to_rows(val)
+
+        # fill buffer
+        self.s.cat__buf = val
+        self.s.cat__buf_offset = offset
+        self.s.cat__chunk = chunk_num
+        return True
+
+    def _fill_buffer_at(self, auth_id, _idx):
+        """ Fill the buffer with the chunk containing the <_idx>-th item,
+        looking it up in the queue index.
+        Return None if the queue is not indexed, False if the item does not
+        exist.
+        """
+        index = self.queue_index(auth_id)
+        if not len(index):
+            return None
+
+        pos = index.seek(_idx)
+        if pos is None:
+            return False
+
+        chunk_num, pos_in_chunk = pos
+        return self._fill_buffer(auth_id, chunk_num, _idx - pos_in_chunk)
+
+    def _seek(self, auth_id, _idx, rec=True):
+        """ Make sure that the <_idx>-th item is in the buffer.
+        Return its position in the buffer, or None if it is not available.
+        """
         # fill buffer if it is empty
         if self.s.cat__buf_offset is None or self.s.cat__buf is None:
-            res = self._fill_buffer(auth_id, self.s.cat__chunk + 1)
+            res = self._fill_buffer_at(auth_id, _idx)
+            if res is None:  # queue not indexed
+                res = self._fill_buffer(auth_id, self.s.cat__chunk + 1)
             if not res or not rec:
                 return None
 
         # must be a function since buf_offset will change if buffer is filled
         buf_idx = lambda: _idx - self.s.cat__buf_offset
+        buf_len = lambda: columnar.length(self.s.cat__buf)
 
-        if buf_idx() >= len(self.s.cat__buf):
+        if buf_idx() >= buf_len():
             if not self._fill_buffer(auth_id, self.s.cat__chunk + 1):
                 return None
 
-        if buf_idx() < 0:
+        # the item is neither in the current nor in the next chunk: seek it
+        if not 0 <= buf_idx() < buf_len():
+            if not self._fill_buffer_at(auth_id, _idx):
+                return None
+
+        return buf_idx()
+
+    def bufget(self, auth_id, _idx, rec=True):
+        pos = self._seek(auth_id, _idx, rec)
+        if pos is None:
+            return None
+
+        if columnar.is_columnar(self.s.cat__buf):
+            return columnar.row(self.s.cat__buf, pos)
+        return self.s.cat__buf[pos]
+
+    def bufget_batch(self, auth_id, _idx):
+        """ Return the items from <_idx> to the end of the current chunk,
+        as a dict of numpy arrays (COLUMNAR categorizers only).
+        """
+        pos = self._seek(auth_id, _idx)
+        if pos is None:
             return None
+        return columnar.to_arrays(self.s.cat__buf, pos)
+
+    def window(self, name, cls, *args, **kwargs):
+        """ Return the window operator ``name`` (see snowcat.utils.windows),
+        creating it if needed. Its state is stored in ``self.s``, so it is
+        persisted together with the rest of the categorizer state, i.e.:
+
+        >>> self.window('speed', SlidingWindow, 10).push(item['speed'])
+        >>> self.window('speed', SlidingWindow, 10).mean
+        """
+        if name not in self._windows:
+            state_key = 'win__{0}'.format(name)
+            if not self.s.exists(state_key):
+                setattr(self.s, state_key, {})
+            self._windows[name] = cls(self.s.get(state_key), *args, **kwargs)
+        return self._windows[name]
+
+    def start_prefetch(self, auth_id):
+        """ Return a prefetcher for the input queue, or None if prefetching
+        is disabled.
+        """
+        if not self.PREFETCH_DEPTH:
+            return None
+        return fsqueue.ChunkPrefetcher(self.queue_dir(auth_id),
+                                       depth=self.PREFETCH_DEPTH,
+                                       shared=self.SHARED_INPUT)
+
+    def emit(self, queue, item):
+        """ Append an item to the output queue ``queue``.
+        Items are buffered in memory and written in chunks; buffered items
+        are written at every checkpoint, and the state is saved together
+        with them, so that the output is tied to the input offset.
+        If the reader of the queue is fused with this categorizer, the item
+        is processed by it right away.
+        """
+        if self._fused and queue in self._fused:
+            # items written before a crash are read from the queue by the
+            # child (see drain), they must not be processed twice
+            if not self._emitter.replayed(queue):
+                self._fused[queue].push(self._auth_id, item)
+        else:
+            self._emitter.emit(queue, item)
+
+    def start_emitter(self, auth_id):
+        """ Return the emitter used by ``emit`` during a run """
+        return fsqueue.BufferedEmitter(
+            lambda queue: self.queue_dir(auth_id, queue),
+            self.s.cat__emitted,
+            chunk_size=self.EMIT_CHUNK_SIZE,
+            fsync=self.EMIT_FSYNC
+        )
+
+    def commit(self, auth_id, save=False, pipe=None):
+        """ Write the emitted items and save the state with them.
+        Also publish the input offset, used to compute the lag of the stream
+        (see snowcat.admission).
+        The states of the fused categorizers are saved with this one, in the
+        same transaction.
+        If ``pipe`` is given the redis commands are only queued on it.
+        """
+        cats = [self] + self.all_fused()
+        if any(c._emitter.pending() for c in cats) or len(cats) > 1:
+            save = True
+
+        p = self.redis_for(auth_id).pipeline() if pipe is None else pipe
+        progress = self.shared_key(auth_id, 'progress')
+        for cat in cats:
+            cat._emitter.flush()
+            if save:
+                cat.s.save(p)
+            if cat.s.get('cat__finished'):
+                # finished categorizers don't count in the lag of the stream
+                # (the offset may still be queued on ``pipe``)
+                p.hdel(progress, cat.name)
+            else:
+                p.hset(progress, cat.name, cat.s.idx)
+        if pipe is None:
+            p.execute()
+
+    @property
+    def fused_children(self):
+        """ Return the names of the children which run in this task """
+        if not hasattr(self, '_fused_children') or \
+                self._fused_children is None:
+            self._fused_children = [
+                c for c in self.children
+                if self.app.tasks[c].FUSE and
+                fusion_error(self.app, self.app.tasks[c]) is None
+            ]
+        return list(self._fused_children)
+
+    def start_fused(self, auth_id):
+        """ Load the fused children, which will receive the items emitted by
+        this categorizer during the run. Children that are running in their
+        own task (i.e. started before they were fused) are not fused.
+        """
+        self._fused, self._fused_locks = {}, {}
+        for name in self.fused_children:
+            child = self.app.tasks[name]
+            lock = self.redis_for(auth_id).lock(child.gen_key(auth_id, 'lock'),
+                                                timeout=LOCK_EXPIRE)
+            if not lock.acquire(blocking=False):
+                continue
+            if not child.is_active(auth_id) or \
+                    child.has_finished(auth_id, child.name):
+                lock.release()
+                continue
+            self._fused_locks[name] = lock
+
+            child._auth_id = auth_id
+            child.kv = SimpleKV(auth_id)
+            child.s = child.load_state(auth_id)
+            child.s.loop = True
+            child._windows = {}
+            child._emitter = child.start_emitter(auth_id)
+            self._fused[child.INPUT_QUEUE] = child
+
+            child.start_fused(auth_id)
+            child.pre_run(auth_id)
+            child.drain(auth_id)
+
+    def all_fused(self):
+        """ Return the categorizers fused with this one, recursively """
+        res = []
+        for child in (self._fused or {}).itervalues():
+            res.append(child)
+            res.extend(child.all_fused())
+        return res
+
+    def push(self, auth_id, item):
+        """ Process an item emitted by the parent of a fused categorizer """
+        if self.s.loop:
+            self.process(auth_id, item)
+
+    def drain(self, auth_id):
+        """ Process the items written to the input queue of a fused
+        categorizer, i.e. before it was fused.
+        """
+        while self.s.loop:
+            item = self.bufget(auth_id, self.s.idx)
+            if item is None:
+                break
+            self.process(auth_id, item)
+            self.s.idx += 1
+
+    def checkpoint_fused(self, auth_id):
+        for child in (self._fused or {}).itervalues():
+            child.drain(auth_id)
+            child.checkpoint(auth_id)
+            child.checkpoint_fused(auth_id)
+            child.s.last_save = time.time()
+
+    def stop_fused(self, auth_id):
+        """ Run post_run on the fused children and release them.
+        Must be called after the states have been committed.
+        """
+        for child in (self._fused or {}).itervalues():
+            child.post_run(auth_id)
+            child.stop_fused(auth_id)
+            child.s.save()
+            # new data written to the queue after the last drain
+            if child.s.loop and child.bufget(auth_id, child.s.idx) is not None:
+                child.reschedule(auth_id)
+
+            child.s = None
+            child._windows = None
+            child._emitter = None
+            child._auth_id = None
+        self._fused = None
+        self.release_fused()
+
+    def release_fused(self):
+        for lock in (self._fused_locks or {}).itervalues():
+            lock.release()
+        self._fused_locks = None
+
+    def ready_key(self):
+        """ Sorted set of the streams ready for a coalesced run """
+        return 'snowcat:ready:{0}'.format(self.name)
+
+    def _schedule_coalesced(self, countdown):
+        """ Start a RunCoalesced task, unless one is already scheduled.
+        Return True if it was started.
+        """
+        flag = '{0}:scheduled'.format(self.ready_key())
+        if not self.redis_client.set(flag, 1, nx=True, ex=60):
+            return False
+        self.app.tasks['RunCoalesced'].apply_async(
+            args=(self.name,), countdown=countdown)
+        return True
+
+    def mark_ready(self, auth_id):
+        """ Mark the stream as ready for a coalesced run (see COALESCE) """
+        # NX: a stream marked again keeps its place in the queue
+        self.redis_client.execute_command('ZADD', self.ready_key(), 'NX',
+                                          time.time(), auth_id)
+        self._schedule_coalesced(self.COALESCE_DELAY)
 
-        return self.s.cat__buf[buf_idx()]
+    def claim_ready(self):
+        """ Return the first COALESCE ready streams, removing them from the
+        ready set. If more streams are ready, another task is scheduled.
+        """
+        key = self.ready_key()
+        p = self.redis_client.pipeline()
+        p.delete('{0}:scheduled'.format(key))
+        p.zrange(key, 0, self.COALESCE - 1)
+        p.zremrangebyrank(key, 0, self.COALESCE - 1)
+        p.zcard(key)
+        _, auth_ids, _, left = p.execute()
+
+        if left:
+            self._schedule_coalesced(0)
+        return auth_ids
+
+    def sweep_ready(self):
+        """ Start a RunCoalesced task if streams are ready and none is
+        scheduled, i.e. because the scheduled one was lost; otherwise the
+        ready streams wait for another stream to be marked.
+        Return True if a task was started.
+        """
+        if not self.redis_client.zcard(self.ready_key()):
+            return False
+        return self._schedule_coalesced(0)
+
+    def run_if_not_already_running(self, user, *args, **kwargs):
+        if self.COALESCE:
+            self.mark_ready(user)
+        else:
+            super(LoopCategorizer, self).run_if_not_already_running(
+                user, *args, **kwargs)
+
+    def reschedule(self, auth_id):
+        """ Run again on the stream, i.e. because new data arrived """
+        if self.COALESCE:
+            self.mark_ready(auth_id)
+        else:
+            self.apply_async(countdown=2, args=(auth_id,))
+
+    def call_children(self, auth_id):
+        """ Call all the categorizers which depend on this one; the fused
+        ones call their own children instead.
+        """
+        for cat in self.children:
+            task = self.app.tasks[cat]
+            if self._fused and task in self._fused.itervalues():
+                if task.CALL_CHILDREN:
+                    task.call_children(auth_id)
+            else:
+                task.run_if_not_already_running(auth_id)
+
+    def state_path(self, auth_id):
+        """ Path of the database of the state, if SPILL_STATE is set """
+        return os.path.join(self.FSQUEUE_PREFIX, str(auth_id),
+                            '{0}.state'.format(self.name))
+
+    def load_state(self, auth_id, load=True):
+        """ Return the state of the categorizer for the stream (self.s).
+        If load is False a PersistentObject is returned without loading it.
+        """
+        if not self.SPILL_STATE:
+            return PersistentObject(
+                self.gen_key(auth_id),
+                default=self.default_s(),
+                redis_client=self.redis_for(auth_id),
+                load=load
+            )
+        return SpillableObject(
+            self.gen_key(auth_id),
+            self.state_path(auth_id),
+            default=self.default_s(),
+            spill=self.SPILL_STATE,
+            max_items=self.SPILL_MAX_ITEMS,
+            redis_client=self.redis_for(auth_id)
+        )
+
+    def finalize(self, user, cleanup=True):
+        # the input offset is no longer published (see commit)
+        if self.s is not None and self.s.namespace == self.gen_key(user):
+            self.s.cat__finished = True
+        return super(LoopCategorizer, self).finalize(user, cleanup)
+
+    def cleanup(self, user):
+        super(LoopCategorizer, self).cleanup(user)
+        if self.debug:
+            return
+
+        path = self.state_path(user)
+        if self.SPILL_STATE and os.path.exists(path):
+            os.remove(path)
+
+    def default_s(self):
+        """ Return the default data to put into persistent storage """
+        def_s = {
+            'idx': 0,
+            'last_save': 0.0,
+            'loop': True,
+            'cat__chunk': 0,
+            'cat__buf': None,
+            'cat__buf_offset': None,
+            'cat__emitted': {},
+            'cat__finished': False
+        }
+        def_s.update(self.DEFAULT_S)
+        return def_s
 
     @singleton_task
     def run(self, auth_id):
@@ -364,66 +825,176 @@ class LoopCategorizer(Categorizer):
             self.logger.debug('Already finished, stopping now.')
             return
 
-        # default data to put into persistent storage
-        def_s = {
-            'idx': 0,
-            'last_save': 0.0,
-            'loop': True,
-            'cat__chunk': 0,
-            'cat__buf': None,
-            'cat__buf_offset': None
-        }
-        def_s.update(self.DEFAULT_S)
-
         self.kv = SimpleKV(auth_id)  # global keyvalue storage
 
         # local keyvalue storage
-        self.s = PersistentObject(
-            self.gen_key(auth_id),
-            default=def_s
-        )
+        self.s = self.load_state(auth_id)
+        self.run_stream(auth_id)
+
+    def run_batch(self, auth_ids):
+        """ Run the categorizer on many streams in turn (see COALESCE).
+        For each redis node, the locks, the finished flags and the states of
+        its streams are fetched with one pipeline; states are committed and
+        locks released with another one.
+        """
+        nodes = {}
+        for auth_id in auth_ids:
+            client = self.redis_for(auth_id)
+            nodes.setdefault(id(client), (client, []))[1].append(auth_id)
+
+        for client, ids in nodes.itervalues():
+            tokens = dict((auth_id, uuid.uuid1().hex) for auth_id in ids)
+            states = {}
+            p = client.pipeline(transaction=False)
+            p.hgetall(PROFILE_KEY)
+            for auth_id in ids:
+                p.set(self.gen_key(auth_id, 'lock'), tokens[auth_id],
+                      nx=True, px=int(LOCK_EXPIRE * 1000))
+                p.get('{0}:finished'.format(auth_id))
+                p.sismember('{0}:finished_tasks'.format(auth_id), self.name)
+                p.hget(SimpleKV(auth_id, client)._redis_ns,
+                       'categorizers_initialization_finished')
+                if not self.SPILL_STATE:
+                    states[auth_id] = self.load_state(auth_id, load=False)
+                    p.get(states[auth_id]._redis_ns)
+            res = iter(p.execute())
+            profile_settings = next(res)
+
+            release = client.register_script(_RELEASE_LOCKS_LUA)
+            commit = client.pipeline()
+            locked, done = [], []
+            committed = False
+            try:
+                for auth_id in ids:
+                    have_lock, finished, cat_finished, initialized = \
+                        [next(res) for _ in xrange(4)]
+                    serialized = next(res) if not self.SPILL_STATE else None
+
+                    if not have_lock:
+                        continue
+                    locked.append(auth_id)
+                    if finished or cat_finished:
+                        continue
+
+                    self.s = None
+                    with report_run(self, auth_id, lambda: self.s), \
+                            profile_run(self, auth_id, profile_settings):
+                        if not initialized:
+                            initialize_categorizers(self.app, auth_id)
+                        if not self.is_active(auth_id):
+                            if self.CALL_CHILDREN:
+                                self.call_children(auth_id)
+                            continue
+
+                        self.kv = SimpleKV(auth_id, client)
+                        if self.SPILL_STATE:
+                            self.s = self.load_state(auth_id)
+                        else:
+                            self.s = states[auth_id]
+                            self.s.loads(serialized)
+                        state = self.s
+                        self.run_stream(auth_id, commit)
+                        if state.loop:
+                            done.append((auth_id, state.idx))
+
+                if locked:
+                    release(keys=[self.gen_key(a, 'lock') for a in locked],
+                            args=[tokens[a] for a in locked], client=commit)
+                commit.execute()
+                committed = True
+            finally:
+                # the states are not committed, but the locks must not be
+                # held until they expire (releasing twice is harmless)
+                if locked and not committed:
+                    release(keys=[self.gen_key(a, 'lock') for a in locked],
+                            args=[tokens[a] for a in locked], client=client)
+
+            # data which arrived while the locks were held
+            for auth_id, idx in done:
+                if self.queue_index(auth_id).total_items() > idx:
+                    self.mark_ready(auth_id)
+
+    def run_stream(self, auth_id, pipe=None):
+        """ Process the new items of a stream, once self.s is loaded.
+        If ``pipe`` is given (coalesced runs) the state is committed on it
+        at the end of the run, and it is up to the caller to execute it.
+        """
         self.s.loop = True
+        self._auth_id = auth_id
+        self._windows = {}
+        self._prefetcher = self.start_prefetch(auth_id)
+        self._emitter = self.start_emitter(auth_id)
 
-        self.pre_run(auth_id)
-
-        while self.s.loop:
-            item = self.bufget(auth_id, self.s.idx)
-
-            time_since_last_save = time.time() - self.s.last_save
-
-            if item is None or time_since_last_save > self.CHECKPOINT_FREQUENCY:
-                if self.CALL_CHILDREN:
-                    self.call_children(auth_id)
-
-                self.checkpoint(auth_id)
-                self.s.last_save = time.time()
-
-            if item is None:
-                break
-
-            self.process(auth_id, item)
-
-            self.s.idx += 1
-
-        self.s.save()
-
-        self.post_run(auth_id)
-
-        # todo: a different, asynchronous task to check if new data is available
-        #       since now there is still a little time frame where
-        #       race conditions may occur.
-        if self.s.loop:
-            # check if new data has been added in the meantime
-            item = self.bufget(auth_id, self.s.idx)
-            if item is not None:
-                self.apply_async(countdown=2, args=(auth_id,))
+        try:
+            if pipe is None:
+                self.start_fused(auth_id)
+            self.pre_run(auth_id)
+
+            while self.s.loop:
+                if self.COLUMNAR:
+                    item = self.bufget_batch(auth_id, self.s.idx)
+                else:
+                    item = self.bufget(auth_id, self.s.idx)
+
+                time_since_last_save = time.time() - self.s.last_save
+
+                if item is None or time_since_last_save > self.CHECKPOINT_FREQUENCY:
+                    self.checkpoint(auth_id)
+                    self.checkpoint_fused(auth_id)
+                    self.commit(auth_id, pipe=pipe)
+                    self.s.last_save = time.time()
+
+                    if self.CALL_CHILDREN:
+                        self.call_children(auth_id)
+
+                if item is None:
+                    break
+
+                if self.COLUMNAR:
+                    self.process_batch(auth_id, item)
+                    self.s.idx += len(item.itervalues().next())
+                else:
+                    self.process(auth_id, item)
+                    self.s.idx += 1
+
+            self.commit(auth_id, save=True, pipe=pipe)
+
+            self.post_run(auth_id)
+            self.stop_fused(auth_id)
+
+            # todo: a different, asynchronous task to check if new data is available
+            #       since now there is still a little time frame where
+            #       race conditions may occur.
+            if self.s.loop and pipe is None:
+                # check if new data has been added in the meantime
+                item = self.bufget(auth_id, self.s.idx)
+                if item is not None:
+                    self.reschedule(auth_id)
+        finally:
+            if self._prefetcher is not None:
+                self._prefetcher.close()
+            self.release_fused()
 
         self.s = None
+        self._auth_id = None
+        self._windows = None
+        self._prefetcher = None
+        self._emitter = None
 
     @abstractmethod
     def process(self, auth_id, item):
         pass
 
+    def process_batch(self, auth_id, columns):
+        """ Process a batch of items, given as a dict of numpy arrays with
+        one array for each field of INPUT_SCHEMA (COLUMNAR categorizers only).
+        Override it to process whole chunks at once; by default each
+        record is passed to ``process``.
+        """
+        names = columns.keys()
+        for values in zip(*[columns[n].tolist() for n in names]):
+            self.process(auth_id, dict(zip(names, values)))
+
     @abstractmethod
     def checkpoint(self, auth_id):
         pass
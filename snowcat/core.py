@@ -1,16 +1,42 @@
 from tasks import BaseAddData
-from categorizers import get_all_categorizers
+from categorizers import get_all_categorizers, fusion_error
 
 
 class Topology(object):
-    def __init__(self, name, app, add_data=BaseAddData):
+    def __init__(self, name, app, add_data=BaseAddData, admission=None):
+        """
+        :param admission: AdmissionControl class (or factory taking the
+         celery app) used to check new data before sending it; add_data
+         then raises Backpressure exceptions. None (the default) disables
+         the checks here; the add_data task can still shed data (see
+         BaseAddData.ADMISSION_CONTROL).
+        """
         self.name = name
         self.app = app
         self._add_data = add_data()
         self._add_data.bind(self.app)
+        self.admission = admission(app) if admission is not None else None
 
     def add_data(self, data, redis_queue='Stream'):
-        return self._add_data.delay(data, redis_queue)
+        """ Send new data to the categorizers.
+        Raise snowcat.admission.DelayIngestion if the client should send the
+        data again later, or ShedLoad if the data has been dropped.
+        """
+        if self.admission is None:
+            return self._add_data.delay(data, redis_queue)
+        self.admission.admit(data['user'])
+        return self._add_data.delay(data, redis_queue, admitted=True)
+
+    def fusable(self):
+        """ Return the (parent, child) names of the categorizers which can
+        be fused. They are fused only if FUSE = True is set on the child
+        (see LoopCategorizer.FUSE).
+        """
+        res = []
+        for t in get_all_categorizers(self.app):
+            if fusion_error(self.app, t) is None:
+                res.append((t.DEPENDENCIES[0], t.name))
+        return sorted(res)
 
     def errors(self):
         errors = list()
@@ -26,5 +52,14 @@ class Topology(object):
                     errors.append(
                         '{0} is not a registered categorizer'.format(dep)
                     )
+            if getattr(t, 'FUSE', False):
+                reason = fusion_error(self.app, t)
+                if reason is not None:
+                    errors.append('{0} can\'t be fused: {1}'
+                                  .format(t.name, reason))
+            if getattr(t, 'COLUMNAR', False) and \
+                    getattr(t, 'INPUT_SCHEMA', None) is None:
+                errors.append('{0} is COLUMNAR but has no INPUT_SCHEMA'
+                              .format(t.name))
 
-
+        return errors
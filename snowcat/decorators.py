@@ -1,8 +1,9 @@
+from contextlib import contextmanager
 from functools import wraps
 import traceback
-import redis
+from profiling import PROFILE_KEY, profile_run
+from utils.sharding import get_redis
 
-redis_client = redis.StrictRedis()
 LOCK_EXPIRE = 60 * 60  # 1 hour
 
 
@@ -15,6 +16,26 @@ def print_s(s):
         )
 
 
+@contextmanager
+def report_run(task, auth_id, state):
+    """ Print the start and the end of the run of ``task`` on a stream.
+    Exceptions are printed, with the state returned by ``state()``, and are
+    not raised.
+    """
+    try:
+        print "{} starting on {}".format(task.name, auth_id)
+        yield
+        print "{} ending on {}".format(task.name, auth_id)
+    except Exception as e:
+        print 'ERROR for {0}: {1}'.format(auth_id, e)
+        print ' ===================== '
+        s = state()
+        if s is not None:
+            print_s(s)
+        print ' --------------------- '
+        print traceback.format_exc()
+
+
 def singleton_task(func):
     """
     Decorator to make the task a pseudo-singleton.
@@ -29,11 +50,18 @@ def singleton_task(func):
         # try to acquire lock
         lock_key = self.gen_key(auth_id, 'lock')
 
+        redis_client = get_redis(auth_id)
         lock = redis_client.lock(lock_key, timeout=LOCK_EXPIRE)
         have_lock = lock.acquire(blocking=False)
 
+        # profiling settings are fetched in the same round trip
+        p = redis_client.pipeline(transaction=False)
+        p.get('{0}:finished'.format(auth_id))
+        p.hgetall(PROFILE_KEY)
+        finished, profile_settings = p.execute()
+
         # if the categorizer has already finished, return immediately
-        if redis_client.get('{0}:finished'.format(auth_id)):
+        if finished:
             if have_lock:
                 lock.release()
             return False
@@ -42,15 +70,9 @@ def singleton_task(func):
             return False
 
         try:
-            print "{} starting on {}".format(self.name, auth_id)
-            func(self, auth_id, *args, **kwargs)
-            print "{} ending on {}".format(self.name, auth_id)
-        except Exception as e:
-            print 'ERROR for {0}: {1}'.format(auth_id, e)
-            print ' ===================== '
-            print_s(self.s)
-            print ' --------------------- '
-            print traceback.format_exc()
+            with report_run(self, auth_id, lambda: getattr(self, 's', None)), \
+                    profile_run(self, auth_id, profile_settings):
+                func(self, auth_id, *args, **kwargs)
         finally:
             lock.release()
             return True
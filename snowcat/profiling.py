@@ -0,0 +1,163 @@
+"""
+On-demand profiling of categorizer runs.
+
+Profiling is switched on and off at runtime through a redis hash, like the
+``snowcat_debug`` flag, so a slow categorizer can be profiled in production
+without redeploying:
+
+>>> enable_profiling(categorizer='WordCounter', auth_id='42')
+>>> disable_profiling()
+
+The settings are read together with the ``finished`` flag at the start of
+every run (see ``singleton_task``), so when profiling is off the only cost
+is an empty reply in a round trip which is done anyway.
+
+Runs of AsyncLoopCategorizers are not profiled: the streams of a worker
+are interleaved on one event loop thread, and their I/O runs in other
+threads, so neither scope could single out the run of one stream.
+"""
+import cProfile
+import os
+import signal
+import time
+from contextlib import contextmanager
+from utils.sharding import all_redis
+
+PROFILE_KEY = 'snowcat_profile'
+
+
+def enable_profiling(categorizer=None, auth_id=None, profiler='cprofile',
+                     scope='run', directory='/tmp/snowcat_profiles',
+                     interval=0.005, redis_client=None):
+    """ Start profiling the runs of a categorizer and/or of a stream.
+    :param categorizer: name of the categorizer, None for all of them.
+    :param auth_id: stream to profile, None for all of them.
+    :param profiler: 'cprofile', or 'sampling' for a low overhead sampling
+     profiler (main thread only) which dumps collapsed stacks, the input
+     format of flamegraph.pl.
+    :param scope: 'run' to profile the whole run, 'hooks' to profile the
+     calls to process and checkpoint only.
+    :param directory: where profile dumps are written.
+    :param interval: seconds between two samples of the sampling profiler.
+    :param redis_client: node to configure; by default all of them, since
+     the settings are read from the node of each stream.
+    """
+
+    settings = {
+        'categorizer': categorizer or '',
+        'auth_id': auth_id or '',
+        'profiler': profiler,
+        'scope': scope,
+        'directory': directory,
+        'interval': interval,
+    }
+    for r in [redis_client] if redis_client is not None else all_redis():
+        p = r.pipeline()
+        p.delete(PROFILE_KEY)
+        p.hmset(PROFILE_KEY, settings)
+        p.execute()
+
+
+def disable_profiling(redis_client=None):
+    for r in [redis_client] if redis_client is not None else all_redis():
+        r.delete(PROFILE_KEY)
+
+
+class SamplingProfiler(object):
+    """ Count the stacks of the main thread every ``interval`` seconds of
+    CPU time, using SIGPROF.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}
+        self._old_handler = None
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{0}:{1}:{2}'.format(
+                os.path.basename(code.co_filename), code.co_name,
+                code.co_firstlineno))
+            frame = frame.f_back
+        key = ';'.join(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def enable(self):
+        self._old_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._old_handler or signal.SIG_DFL)
+
+    def dump_stats(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.iteritems():
+                f.write('{0} {1}\n'.format(stack, count))
+
+
+def _matches(settings, task, auth_id):
+    if not settings:
+        return False
+    if settings.get('categorizer') and settings['categorizer'] != task.name:
+        return False
+    if settings.get('auth_id') and settings['auth_id'] != str(auth_id):
+        return False
+    return True
+
+
+def _wrap(profiler, method):
+    def _inner(*args, **kwargs):
+        profiler.enable()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            profiler.disable()
+    return _inner
+
+
+@contextmanager
+def profile_run(task, auth_id, settings):
+    """ Profile the run of ``task`` on ``auth_id`` if ``settings`` (the
+    content of the PROFILE_KEY hash) match them.
+    """
+    if not _matches(settings, task, auth_id):
+        yield
+        return
+
+    profiler = None
+    ext = 'prof'
+    if settings.get('profiler') == 'sampling':
+        profiler = SamplingProfiler(float(settings.get('interval', 0.005)))
+        ext = 'stacks'
+        try:
+            signal.signal(signal.SIGPROF, signal.getsignal(signal.SIGPROF))
+        except ValueError:  # not in the main thread
+            profiler, ext = None, 'prof'
+    if profiler is None:
+        profiler = cProfile.Profile()
+
+    hooks = settings.get('scope') == 'hooks'
+    if hooks:
+        # shadow the methods on the (shared) task instance for this run only
+        for name in ('process', 'checkpoint'):
+            if hasattr(task, name):
+                setattr(task, name, _wrap(profiler, getattr(task, name)))
+    else:
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if hooks:
+            for name in ('process', 'checkpoint'):
+                task.__dict__.pop(name, None)
+        else:
+            profiler.disable()
+
+        directory = settings.get('directory') or '/tmp/snowcat_profiles'
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        profiler.dump_stats(os.path.join(directory, '{0}-{1}-{2}.{3}'.format(
+            task.name, auth_id, int(time.time() * 1000), ext)))
@@ -1,9 +1,20 @@
 from celery import Task
+from celery.canvas import chain
 from celery.utils.log import get_task_logger
-import redis
 from shutil import rmtree
-from categorizers import get_root_categorizers, LoopCategorizer
+from categorizers import get_root_categorizers, get_all_categorizers, \
+    get_stream_finalizers, LoopCategorizer, _RELEASE_LOCKS_LUA
+from admission import ShedLoad
+from decorators import LOCK_EXPIRE
+from utils.sharding import get_redis, all_redis
 import os
+import time
+import uuid
+
+# sorted set with the time of the last data received by each stream
+STREAM_ACTIVITY_KEY = 'snowcat:activity'
+
+FINISHED_FLAG_TTL = 7 * 24 * 60 * 60
 
 
 class BaseAddData(Task):
@@ -11,7 +22,17 @@ class BaseAddData(Task):
 
     FSQUEUE_PREFIX = '/tmp/snowcat/'
 
-    r = redis.StrictRedis()
+    # queue name -> schema, for queues stored as columnar chunks
+    QUEUE_SCHEMAS = {}
+
+    # AdmissionControl class (or factory taking the celery app) used to shed
+    # data when the node is overloaded; None (the default) disables it.
+    # Data is never delayed here, since retrying the task could reorder the
+    # stream. Data already admitted by Topology.add_data is not checked
+    # again.
+    ADMISSION_CONTROL = None
+
+    _admission = None
 
     @property
     def logger(self):
@@ -26,17 +47,34 @@ class BaseAddData(Task):
             ':' + str(key) if key else ''
         )
 
-    def run(self, data, snowcat_queue='Stream', **kwargs):
+    @property
+    def admission(self):
+        if self._admission is None and self.ADMISSION_CONTROL is not None:
+            self._admission = self.ADMISSION_CONTROL(self.app)
+        return self._admission
+
+    def run(self, data, snowcat_queue='Stream', admitted=False, **kwargs):
         root_categorizers = get_root_categorizers(self.app)
 
         user = data['user']
 
+        if self.admission is not None and not admitted:
+            try:
+                self.admission.admit(user, shed_only=True)
+            except ShedLoad:
+                return False
+
         LoopCategorizer.save_chunk_fs(
             data['data'] if isinstance(data['data'], (tuple, list))
             else [data['data']],
-            os.path.join(self.FSQUEUE_PREFIX, str(user), snowcat_queue, 'queue')
+            os.path.join(self.FSQUEUE_PREFIX, str(user), snowcat_queue, 'queue'),
+            schema=self.QUEUE_SCHEMAS.get(snowcat_queue)
         )
 
+        # version independent ZADD (redis-py 3 changed the signature)
+        get_redis().execute_command('ZADD', STREAM_ACTIVITY_KEY,
+                                    time.time(), user)
+
         for cat in root_categorizers:
             cat.run_if_not_already_running(user)
 
@@ -67,12 +105,12 @@ class FinalizeStream(Task):  # todo: rename class
             fs_prefix='/tmp/snowcat'):
         self.logger.info('finalizing {0}'.format(auth_id))
         if redis_client is None:
-            redis_client = redis.StrictRedis()
+            redis_client = get_redis(auth_id)
 
-        FINISHED_FLAG_TTL = 7 * 24 * 60 * 60
-        redis_client.setex('{0}:finished'.format(auth_id), FINISHED_FLAG_TTL, True)
+        redis_client.setex('{0}:finished'.format(auth_id), FINISHED_FLAG_TTL, 1)
+        get_redis().zrem(STREAM_ACTIVITY_KEY, auth_id)
 
-        if bool(redis_client.get('snowcat_debug')):
+        if bool(get_redis().get('snowcat_debug')):
             return
 
         logger = get_task_logger('stream_finalizer')
@@ -99,3 +137,189 @@ class FinalizeStream(Task):  # todo: rename class
         if not debug:
            # remove queues
            rmtree(os.path.join(fs_prefix, auth_id))
+
+
+class ReapIdleStreams(Task):
+    """ Force the finalization of streams which stopped receiving data
+    without being finalized (i.e. devices disconnected without an end
+    signal), so that their state and queues don't stay around forever.
+
+    Streams idle for more than IDLE_TIMEOUT seconds are finalized; if a
+    redis node uses more than MAX_REDIS_MEMORY bytes, the least recently
+    active streams stored on it are finalized too, and so are the least
+    recently active streams if the queues use more than MAX_DISK_BYTES
+    bytes, BATCH_SIZE at a time. Streams are reaped holding the locks of
+    their categorizers, and skipped if one of them is running.
+    Finalization goes through the registered stream finalizers.
+
+    The task is meant to be scheduled periodically with celery beat.
+    """
+    name = 'ReapIdleStreams'
+
+    FSQUEUE_PREFIX = '/tmp/snowcat/'
+    IDLE_TIMEOUT = 24 * 60 * 60
+    MAX_REDIS_MEMORY = None
+    MAX_DISK_BYTES = None
+    BATCH_SIZE = 100
+
+    @property
+    def logger(self):
+        if not hasattr(self, '_logger'):
+            self._logger = get_task_logger(self.name)
+        return self._logger
+
+    def disk_usage(self):
+        """ Return the bytes used by the queues """
+        total = 0
+        for root, _, files in os.walk(self.FSQUEUE_PREFIX):
+            for f in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, f))
+                except OSError:  # deleted in the meantime
+                    pass
+        return total
+
+    def disk_over_budget(self):
+        if self.MAX_DISK_BYTES is not None:
+            used = self.disk_usage()
+            if used > self.MAX_DISK_BYTES:
+                return 'queues use {0} bytes'.format(used)
+        return None
+
+    def nodes_over_budget(self):
+        """ Return (redis client, reason) for each node using more than
+        MAX_REDIS_MEMORY bytes
+        """
+        if self.MAX_REDIS_MEMORY is None:
+            return []
+        over = []
+        for r in all_redis():
+            used = r.info('memory')['used_memory']
+            if used > self.MAX_REDIS_MEMORY:
+                over.append((r, 'redis uses {0} bytes'.format(used)))
+        return over
+
+    def lru_on(self, redis_client, node):
+        """ Return the BATCH_SIZE least recently active streams stored on
+        the given node
+        """
+        lru = []
+        start = 0
+        while len(lru) < self.BATCH_SIZE:
+            page = redis_client.zrange(STREAM_ACTIVITY_KEY,
+                                       start, start + self.BATCH_SIZE - 1)
+            if not page:
+                break
+            lru.extend(auth_id for auth_id in page
+                       if get_redis(auth_id) is node)
+            start += self.BATCH_SIZE
+        return lru[:self.BATCH_SIZE]
+
+    def lock(self, auth_id):
+        """ Take the locks of all the categorizers on the stream without
+        blocking, as their runs do. Return the locks, or None if one of the
+        categorizers is running.
+        """
+        client = get_redis(auth_id)
+        token = uuid.uuid1().hex
+        keys = [cat.gen_key(auth_id, 'lock')
+                for cat in get_all_categorizers(self.app)]
+        p = client.pipeline(transaction=False)
+        for key in keys:
+            p.set(key, token, nx=True, px=int(LOCK_EXPIRE * 1000))
+        locks = (keys, token)
+        if all(p.execute()):
+            return locks
+        self.unlock(auth_id, locks)
+        return None
+
+    def unlock(self, auth_id, locks):
+        keys, token = locks
+        if keys:
+            get_redis(auth_id).register_script(_RELEASE_LOCKS_LUA)(
+                keys=keys, args=[token] * len(keys))
+
+    def reap(self, redis_client, auth_ids, reason):
+        reaped = []
+        for auth_id in auth_ids:
+            locks = self.lock(auth_id)
+            if locks is None:
+                continue
+
+            self.logger.info('finalizing {0}: {1}'.format(auth_id, reason))
+            try:
+                # no run starts once the locks are released
+                get_redis(auth_id).setex('{0}:finished'.format(auth_id),
+                                         FINISHED_FLAG_TTL, 1)
+                # don't reap it again while the finalizers are running
+                redis_client.zrem(STREAM_ACTIVITY_KEY, auth_id)
+
+                # the categorizers didn't finalize, so their data is still
+                # there
+                for cat in get_all_categorizers(self.app):
+                    cat.cleanup(auth_id)
+            finally:
+                self.unlock(auth_id, locks)
+            chain(*[t.si(auth_id, fs_prefix=self.FSQUEUE_PREFIX)
+                    for t in get_stream_finalizers(self.app)]).delay()
+            reaped.append(auth_id)
+        return reaped
+
+    def run(self, redis_client=None):
+        if redis_client is None:
+            redis_client = get_redis()
+
+        idle = redis_client.zrangebyscore(
+            STREAM_ACTIVITY_KEY, '-inf', time.time() - self.IDLE_TIMEOUT,
+            start=0, num=self.BATCH_SIZE)
+        reaped = self.reap(redis_client, idle, 'idle')
+
+        # each node frees memory by finalizing its own streams
+        for node, reason in self.nodes_over_budget():
+            reaped.extend(self.reap(redis_client,
+                                    self.lru_on(redis_client, node), reason))
+
+        reason = self.disk_over_budget()
+        if reason is not None:
+            lru = redis_client.zrange(STREAM_ACTIVITY_KEY,
+                                      0, self.BATCH_SIZE - 1)
+            reaped.extend(self.reap(redis_client, lru, reason))
+
+        return reaped
+
+
+class RunCoalesced(Task):
+    """ Run a categorizer on a batch of the streams marked as ready
+    (see LoopCategorizer.COALESCE).
+    """
+    name = 'RunCoalesced'
+
+    def run(self, categorizer):
+        cat = self.app.tasks[categorizer]
+        auth_ids = cat.claim_ready()
+        if auth_ids:
+            try:
+                cat.run_batch(auth_ids)
+            except Exception:
+                # the states were not committed: run them again later
+                for auth_id in auth_ids:
+                    cat.mark_ready(auth_id)
+                raise
+        return len(auth_ids)
+
+
+class SweepReady(Task):
+    """ Start a RunCoalesced task for each coalesced categorizer with ready
+    streams and no task scheduled, i.e. because the scheduled task was lost
+    (see LoopCategorizer.COALESCE).
+
+    The task is meant to be scheduled periodically with celery beat.
+    """
+    name = 'SweepReady'
+
+    def run(self):
+        swept = []
+        for cat in get_all_categorizers(self.app):
+            if getattr(cat, 'COALESCE', 0) and cat.sweep_ready():
+                swept.append(cat.name)
+        return sorted(swept)
@@ -0,0 +1,98 @@
+"""
+Typed columnar chunks, for fixed-schema numeric streams (i.e. tracks).
+
+A columnar chunk is still a messagepack document, so it can be stored in the
+same queues as the row oriented ones:
+
+    {'columnar': 1,
+     'schema': [['timestamp', 'f8'], ['lat', 'f8'], ...],
+     'length': <number of records>,
+     'columns': [<raw bytes of column 1>, <raw bytes of column 2>, ...]}
+
+Each column is a contiguous array, which is decoded to a NumPy array without
+copying and without per-record decoding.
+"""
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for columnar chunks
+    np = None
+
+
+def _check_numpy():
+    if np is None:
+        raise ImportError('numpy is required to use columnar chunks '
+                          '(pip install SnowCat[columnar])')
+
+
+def normalize_schema(schema):
+    """ Return the schema as a list of [name, dtype string] pairs.
+    The schema can be given as a list of (name, dtype) pairs or as a
+    numpy structured dtype.
+    """
+    _check_numpy()
+    if isinstance(schema, np.dtype):
+        schema = [(name, schema.fields[name][0]) for name in schema.names]
+    return [[str(name), np.dtype(dtype).str] for name, dtype in schema]
+
+
+def is_columnar(chunk):
+    return isinstance(chunk, dict) and chunk.get('columnar') == 1
+
+
+def length(chunk):
+    """ Number of records in a chunk (columnar or not) """
+    if is_columnar(chunk):
+        return chunk['length']
+    return len(chunk)
+
+
+def from_rows(rows, schema):
+    """ Build a columnar chunk from a list of dicts (or sequences ordered as
+    the schema).
+    """
+    schema = normalize_schema(schema)
+    columns = []
+    for i, (name, dtype) in enumerate(schema):
+        values = [r[name] if isinstance(r, dict) else r[i] for r in rows]
+        columns.append(np.asarray(values, dtype=dtype).tobytes())
+    return {'columnar': 1, 'schema': schema, 'length': len(rows),
+            'columns': columns}
+
+
+def from_arrays(arrays, schema):
+    """ Build a columnar chunk from a dict of arrays, one for each field """
+    schema = normalize_schema(schema)
+    lengths = set(len(arrays[name]) for name, _ in schema)
+    if len(lengths) > 1:
+        raise ValueError('columns must have the same length')
+    columns = [np.ascontiguousarray(arrays[name], dtype=dtype).tobytes()
+               for name, dtype in schema]
+    return {'columnar': 1, 'schema': schema,
+            'length': lengths.pop() if lengths else 0, 'columns': columns}
+
+
+def to_arrays(chunk, start=0, stop=None):
+    """ Return a dict of read-only NumPy arrays (one for each field) with the
+    records from ``start`` to ``stop`` of a columnar chunk.
+    """
+    _check_numpy()
+    res = {}
+    for (name, dtype), raw in zip(chunk['schema'], chunk['columns']):
+        res[name] = np.frombuffer(raw, dtype=dtype)[start:stop]
+    return res
+
+
+def row(chunk, i):
+    """ Return the i-th record of a columnar chunk as a dict """
+    return {name: column[0].item()
+            for name, column in to_arrays(chunk, i, i + 1).iteritems()}
+
+
+def to_rows(chunk):
+    """ Convert a columnar chunk to a list of dicts, for row oriented
+    categorizers.
+    """
+    arrays = to_arrays(chunk)
+    names = [name for name, _ in chunk['schema']]
+    columns = [arrays[name].tolist() for name in names]
+    return [dict(zip(names, values)) for values in zip(*columns)]
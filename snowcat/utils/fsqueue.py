@@ -0,0 +1,464 @@
+"""
+Helpers for the file system queues.
+
+A queue is a directory with one messagepack file (chunk) for each call to
+``LoopCategorizer.save_chunk_fs``; chunks are numbered from 1.
+Next to the queue directory a sparse index maps the index of each item to
+the chunk which contains it, so that any item can be reached in O(log n)
+without reading the previous chunks.
+"""
+import os
+import Queue
+import struct
+import sys
+import threading
+from collections import OrderedDict
+import msgpack
+from lockfile import LockFile
+import columnar
+
+
+def chunk_path(queue_dir, chunk_num):
+    return os.path.join(queue_dir, str(chunk_num))
+
+
+def load_chunk(queue_dir, chunk_num, shared=False):
+    """ Load the <chunk_num>-th chunk of a queue.
+    Return None if the chunk does not exist.
+    If shared is True the chunk is taken from the per-process chunk cache
+    (see ChunkCache): it is decoded once for all the consumers of the queue,
+    and it is read only.
+    """
+    if shared:
+        return chunk_cache.get(queue_dir, chunk_num)
+
+    file_path = chunk_path(queue_dir, chunk_num)
+    if not os.path.exists(file_path):
+        return None
+
+    lock = LockFile(file_path)
+    with lock, open(file_path, 'rb') as f:  # todo: lock timeout
+        return msgpack.unpack(f)
+
+
+def append_chunk(data, queue_dir, fsync=False):
+    """ Append a chunk to a queue, creating the queue if needed, and index
+    it. See LoopCategorizer.save_chunk_fs.
+    """
+    # todo: give option to set index manually
+    try:
+        ls = os.listdir(queue_dir)
+    except OSError:
+        if not os.path.exists(queue_dir):
+            os.makedirs(queue_dir)
+            ls = []
+        else:
+            return False
+
+    index = QueueIndex(queue_dir)
+    with index.lock():
+        # list the chunks again, holding the lock
+        ls = os.listdir(queue_dir)
+
+        mx = 0
+        for s in ls:
+            try:
+                num = int(s)
+            except ValueError:
+                continue
+            mx = max(mx, num)
+
+        # a crash between the write of a chunk and its record leaves the
+        # index behind the queue: all the following records would be wrong
+        if not index.ends_with(mx):
+            index.rebuild()
+
+        file_path = chunk_path(queue_dir, mx + 1)
+        lock = LockFile(file_path)
+        with lock, open(file_path, 'wb') as f:
+            f.write(msgpack.dumps(data))
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+        index.append(mx + 1, columnar.length(data) if data else 0,
+                     fsync=fsync)
+    return True
+
+
+class FrozenDict(dict):
+    """ A dict which can't be modified, used for the cached chunks """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('cached chunks are read only')
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+
+def decoded_size(obj):
+    """ Estimate the memory used by a decoded chunk, in bytes: the sum of
+    the sizes of all the objects it contains. Shared objects (i.e. small
+    ints) are counted each time, so the estimate errs on the large side.
+    """
+    size = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.iterkeys())
+            stack.extend(o.itervalues())
+        elif isinstance(o, (list, tuple)):
+            stack.extend(o)
+    return size
+
+
+class ChunkCache(object):
+    """
+    LRU cache of decoded chunks, shared by the categorizers running in the
+    same worker process: when many categorizers read the same queue, each
+    chunk is read and decoded once.
+    Chunks are decoded as immutable objects (tuples and FrozenDicts), so no
+    consumer can alter what the others see.
+    The memory budget is measured on the decoded chunks (see decoded_size),
+    which take several times the size of their files (6 to 15 times for
+    chunks of small dicts).
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<ChunkCache {0} chunks, {1}/{2} bytes>'.format(
+            len(self._chunks), self.size, self.max_bytes)
+
+    def get(self, queue_dir, chunk_num):
+        """ Return the decoded chunk, or None if it does not exist """
+        file_path = chunk_path(queue_dir, chunk_num)
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+
+        # a queue may be deleted and created again with the same path:
+        # the inode and the mtime tell the two chunks apart.
+        key = (file_path, st.st_ino, st.st_mtime)
+        with self._lock:
+            if key in self._chunks:
+                self.hits += 1
+                val, size = self._chunks.pop(key)
+                self._chunks[key] = (val, size)
+                return val
+            self.misses += 1
+
+        lock = LockFile(file_path)
+        with lock, open(file_path, 'rb') as f:  # todo: lock timeout
+            raw = f.read()
+        val = msgpack.unpackb(raw, use_list=False, object_hook=FrozenDict)
+        size = decoded_size(val)
+
+        with self._lock:
+            if key not in self._chunks and size <= self.max_bytes:
+                self._chunks[key] = (val, size)
+                self.size += size
+                while self.size > self.max_bytes:
+                    _, (_, size) = self._chunks.popitem(last=False)
+                    self.size -= size
+        return val
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self.size = 0
+
+
+# one cache for each worker process
+chunk_cache = ChunkCache()
+
+
+class QueueIndex(object):
+    """
+    Sparse offset index of a queue: one fixed size record for each chunk,
+    holding the index of its first item, the chunk number and the number of
+    items. Records are only appended, so readers don't need any lock.
+    """
+    RECORD = struct.Struct('<QQQ')
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        self.path = os.path.join(os.path.dirname(queue_dir), 'index')
+
+    def __repr__(self):
+        return '<QueueIndex "{0}">'.format(self.path)
+
+    def __len__(self):
+        """ Number of indexed chunks """
+        try:
+            return os.path.getsize(self.path) // self.RECORD.size
+        except OSError:
+            return 0
+
+    def lock(self):
+        """ Lock to be held when appending chunks to the queue """
+        return LockFile(self.path)
+
+    def _read(self, f, i):
+        f.seek(i * self.RECORD.size)
+        return self.RECORD.unpack(f.read(self.RECORD.size))
+
+    def entry(self, i):
+        """ Return (first item index, chunk number, items) of the i-th chunk
+        """
+        with open(self.path, 'rb') as f:
+            return self._read(f, i)
+
+    def total_items(self):
+        n = len(self)
+        if not n:
+            return 0
+        start, _, count = self.entry(n - 1)
+        return start + count
+
+    def ends_with(self, chunk_num):
+        """ Return True if the last record of the index is the one of the
+        <chunk_num>-th chunk (0 for an empty queue) and it is complete.
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size % self.RECORD.size:
+            return False
+        if not size:
+            return chunk_num == 0
+        return self.entry(size // self.RECORD.size - 1)[1] == chunk_num
+
+    def append(self, chunk_num, count, fsync=False):
+        """ Index a new chunk. Must be called holding ``lock``. """
+        with open(self.path, 'ab') as f:
+            f.write(self.RECORD.pack(self.total_items(), chunk_num, count))
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def rebuild(self):
+        """ Index a queue written before the index existed (or whose index
+        got lost). Must be called holding ``lock``.
+        """
+        chunks = []
+        for name in os.listdir(self.queue_dir):
+            try:
+                chunks.append(int(name))
+            except ValueError:
+                continue
+
+        # readers don't lock the index: write the new one aside and replace
+        # the old one atomically, so that they never see it partially written
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            start = 0
+            for chunk_num in sorted(chunks):
+                chunk = load_chunk(self.queue_dir, chunk_num)
+                count = columnar.length(chunk) if chunk else 0
+                f.write(self.RECORD.pack(start, chunk_num, count))
+                start += count
+        os.rename(tmp_path, self.path)
+
+    def seek(self, item_idx):
+        """ Return (chunk number, index of the item inside the chunk) of the
+        <item_idx>-th item of the queue, or None if it doesn't exist yet.
+        """
+        n = len(self)
+        if not n:
+            return None
+
+        with open(self.path, 'rb') as f:
+            # find the last chunk whose first item is <= item_idx
+            lo, hi = 0, n
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._read(f, mid)[0] <= item_idx:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if not lo:
+                return None
+            start, chunk_num, count = self._read(f, lo - 1)
+
+        if item_idx >= start + count:
+            return None
+        return chunk_num, item_idx - start
+
+
+def iter_items(queue_dir, start=0):
+    """ Iterate over the items of a queue, starting from the <start>-th one.
+    Useful for replays, inspection or partial reprocessing.
+    """
+    index = QueueIndex(queue_dir)
+    pos = index.seek(start)
+    if pos is None:
+        return
+
+    chunk_num, offset = pos
+    while True:
+        chunk = load_chunk(queue_dir, chunk_num)
+        if chunk is None:
+            return
+        if chunk:
+            if columnar.is_columnar(chunk):
+                chunk = columnar.to_rows(chunk)
+            for item in chunk[offset:]:
+                yield item
+        chunk_num, offset = chunk_num + 1, 0
+
+
+def read_item(queue_dir, item_idx):
+    """ Return the <item_idx>-th item of a queue, or None """
+    for item in iter_items(queue_dir, item_idx):
+        return item
+    return None
+
+
+class ChunkPrefetcher(object):
+    """
+    Load the chunks following the one being processed in a background
+    thread, so that the processing loop doesn't stall on file locks and
+    decoding at every chunk boundary.
+    At most ``depth`` chunks are kept in memory. Chunks which did not exist
+    yet when they were prefetched are loaded again when they are requested.
+    """
+    def __init__(self, queue_dir, depth=1, shared=False):
+        self.queue_dir = queue_dir
+        self.depth = depth
+        self.shared = shared
+
+        self._results = {}  # chunk number -> [loaded event, chunk]
+        self._lock = threading.Lock()
+        self._requests = Queue.Queue()
+        self._thread = threading.Thread(target=self._work,
+                                        name='snowcat-prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __repr__(self):
+        return '<ChunkPrefetcher "{0}">'.format(self.queue_dir)
+
+    def _work(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+
+            chunk_num, entry = request
+            try:
+                entry[1] = load_chunk(self.queue_dir, chunk_num, self.shared)
+            except Exception:  # get() will load it again and raise
+                entry[1] = None
+            entry[0].set()
+
+    def get(self, chunk_num):
+        """ Return the <chunk_num>-th chunk, or None if it does not exist,
+        and start prefetching the next ones.
+        """
+        with self._lock:
+            # discard the chunks before the requested one
+            for n in [n for n in self._results if n < chunk_num]:
+                del self._results[n]
+            entry = self._results.pop(chunk_num, None)
+
+            for n in xrange(chunk_num + 1, chunk_num + 1 + self.depth):
+                if n not in self._results:
+                    self._results[n] = [threading.Event(), None]
+                    self._requests.put((n, self._results[n]))
+
+        if entry is not None:
+            entry[0].wait()
+            if entry[1] is not None:
+                return entry[1]
+
+        return load_chunk(self.queue_dir, chunk_num, self.shared)
+
+    def close(self):
+        with self._lock:
+            self._results.clear()
+        self._requests.put(None)
+
+
+class BufferedEmitter(object):
+    """
+    Buffer the items emitted by a categorizer and append them to their
+    queues in chunks of ``chunk_size`` items, or when ``flush`` is called.
+
+    ``committed`` maps each queue to the number of items emitted to it; it
+    must be stored in the state of the categorizer, so that it is committed
+    together with the input offset. After a crash, the items which were
+    written past the committed state are emitted again by the categorizer
+    and are skipped here, so each item is written once. For this reason a
+    queue written through an emitter must not have other writers.
+    """
+    def __init__(self, queue_dir, committed, chunk_size=1000, fsync=False):
+        """
+        :param queue_dir: function returning the directory of a queue given
+         its name.
+        """
+        self.queue_dir = queue_dir
+        self.committed = committed
+        self.chunk_size = chunk_size
+        self.fsync = fsync
+
+        self._buffers = {}
+        self._skip = {}
+
+    def __repr__(self):
+        return '<BufferedEmitter {0}>'.format(
+            {q: len(b) for q, b in self._buffers.iteritems()})
+
+    def emit(self, queue, item):
+        if self.replayed(queue):
+            return
+
+        buf = self._buffers[queue]
+        buf.append(item)
+        if len(buf) >= self.chunk_size:
+            self.flush(queue)
+
+    def replayed(self, queue):
+        """ Return True if the next item emitted to ``queue`` was already
+        written before a crash; it is then counted as written.
+        Items passed on without ``emit`` must be checked here too, so that
+        the items already in the queue are skipped.
+        """
+        if queue not in self._buffers:
+            self._buffers[queue] = []
+            written = QueueIndex(self.queue_dir(queue)).total_items()
+            self._skip[queue] = written - self.committed.get(queue, 0)
+
+        if self._skip[queue] > 0:
+            self._skip[queue] -= 1
+            self.committed[queue] = self.committed.get(queue, 0) + 1
+            return True
+        return False
+
+    def pending(self):
+        """ Return True if some item has not been written yet """
+        return any(self._buffers.itervalues())
+
+    def flush(self, queue=None):
+        """ Write the buffered items of ``queue`` (of all queues if None),
+        one chunk for each queue.
+        Raise IOError if a queue can't be written; its items stay buffered.
+        """
+        queues = [queue] if queue is not None else self._buffers.keys()
+        for q in queues:
+            buf = self._buffers.get(q)
+            if not buf:
+                continue
+            queue_dir = self.queue_dir(q)
+            if not append_chunk(buf, queue_dir, fsync=self.fsync):
+                raise IOError('can\'t append a chunk to {0}'.format(queue_dir))
+            self.committed[q] = self.committed.get(q, 0) + len(buf)
+            self._buffers[q] = []
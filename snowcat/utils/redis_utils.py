@@ -1,6 +1,10 @@
-import redis
+import hashlib
+from abc import ABCMeta, abstractmethod
+import math
+import struct
 import msgpack
 from copy import deepcopy
+from sharding import get_redis, require_redis
 
 
 class SimpleKV(object):
@@ -13,9 +17,15 @@ class SimpleKV(object):
     >>> s.foo
     'bar'
     """
-    def __init__(self, namespace):
+    def __init__(self, namespace, redis_client=None):
+        """
+        :param namespace: usually the auth_id of a stream, which is used to
+         choose the redis node when redis_client is not given.
+        """
+        if redis_client is None:
+            redis_client = get_redis(namespace)
         self._obj_setattr('namespace', str(namespace))
-        self._obj_setattr('redis_client', redis.StrictRedis())
+        self._obj_setattr('redis_client', redis_client)
 
     def __getattr__(self, item):
         r_client = object.__getattribute__(self, 'redis_client')
@@ -86,14 +96,20 @@ class PersistentObject(object):
     Similar to SimpleKV, but much faster since redis is involved in load / save
     operations only. Not recommended in concurrent environments.
     """
-    def __init__(self, namespace, default=None):
+    def __init__(self, namespace, default=None, redis_client=None,
+                 load=True):
+        """
+        :param load: if False the data is not loaded (see loads).
+        """
         if default is None:
             default = {}
+        redis_client = require_redis(redis_client, 'PersistentObject')
         object.__setattr__(self, 'namespace', namespace)
         object.__setattr__(self, 'attrs', deepcopy(default))
-        object.__setattr__(self, 'redis_client', redis.StrictRedis())
+        object.__setattr__(self, 'redis_client', redis_client)
 
-        self.load()
+        if load:
+            self.load()
 
     def __getattr__(self, item):
         attrs = object.__getattribute__(self, 'attrs')
@@ -115,13 +131,19 @@ class PersistentObject(object):
         """ Generate the redis key for this PersistentObject """
         return '{0}:PersistentObject'.format(self.namespace)
 
-    def save(self):
-        """ Save the data on redis """
-        self.redis_client.set(self._redis_ns, msgpack.dumps(self.attrs))
+    def save(self, pipe=None):
+        """ Save the data on redis, or queue the write on a pipeline """
+        client = self.redis_client if pipe is None else pipe
+        client.set(self._redis_ns, msgpack.dumps(self.attrs))
 
     def load(self):
         """ Load the data from redis"""
-        serialized = self.redis_client.get(self._redis_ns)
+        self.loads(self.redis_client.get(self._redis_ns))
+
+    def loads(self, serialized):
+        """ Load the data from the value of the redis key (i.e. fetched in a
+        pipeline with other keys).
+        """
         if serialized is not None:
             stored_val = msgpack.loads(serialized)
             self.attrs.update(stored_val or {})
@@ -151,10 +173,28 @@ class PollValue(object):
     class SubscriberDoesNotExist(IndexError):
         pass
 
-    def __init__(self, poll_name):
-        self.redis_client = redis.StrictRedis()
+    # Lua snippet run by the script which completes the poll: it publishes
+    # a snapshot of the votes on the completion list (KEYS[2]), so that
+    # waiters get the results together with the completion signal.
+    _COMPLETE_LUA = """
+            local results = {}
+            local all = redis.call('HGETALL', KEYS[1])
+            for i = 1, #all, 2 do
+                results[all[i]] = all[i + 1]
+            end
+            redis.call('DEL', KEYS[2])
+            redis.call('RPUSH', KEYS[2], cmsgpack.pack(results))
+    """
+
+    def __init__(self, poll_name, redis_client=None):
+        """
+        :param redis_client: client of the node of the stream the poll
+         belongs to (see snowcat.utils.sharding).
+        """
+        self.redis_client = require_redis(redis_client, 'PollValue')
 
         self.poll_name = '{0}:PollValue'.format(poll_name)
+        self.complete_key = '{0}:complete'.format(self.poll_name)
         self.scripts = {}
 
     def _get_script(self, name, lua):
@@ -221,6 +261,7 @@ class PollValue(object):
         end
 
         if everyone_voted then
+            """ + self._COMPLETE_LUA + """
             return 3 -- poll complete
         end
 
@@ -228,7 +269,7 @@ class PollValue(object):
         """
 
         script = self._get_script('vote', lua)
-        res = script(keys=[self.poll_name],
+        res = script(keys=[self.poll_name, self.complete_key],
                      args=[subscriber_name, msgpack.dumps(vote)])
         if res == 0:
             raise self.SubscriberDoesNotExist(
@@ -263,6 +304,7 @@ class PollValue(object):
         end
 
         if everyone_voted then
+            """ + self._COMPLETE_LUA + """
             return 3 -- poll complete
         end
 
@@ -270,7 +312,8 @@ class PollValue(object):
         """
 
         script = self._get_script('null_vote', lua)
-        res = script(keys=[self.poll_name], args=[subscriber_name])
+        res = script(keys=[self.poll_name, self.complete_key],
+                     args=[subscriber_name])
         return res
 
     @property
@@ -291,3 +334,592 @@ class PollValue(object):
                 self.redis_client.hgetall(self.poll_name).values()
             )
         return []
+
+    def _decode_results(self, packed):
+        results = msgpack.loads(packed) or {}
+        return {k: msgpack.loads(v) for k, v in results.iteritems()}
+
+    def wait_complete(self, timeout=0):
+        """ Block until every subscriber voted (or nulled its vote) and
+        return the votes, decoded as in ``PollValue.votes``.
+        The completion list is rotated (not consumed), so any number of
+        waiters can be woken up, even after the poll completed.
+        :param timeout: seconds to wait for; 0 means wait forever. Redis
+         only takes whole seconds, so fractions are rounded up.
+        :return: the votes, or None if the timeout expired.
+        """
+        packed = self.redis_client.brpoplpush(
+            self.complete_key, self.complete_key,
+            timeout=int(math.ceil(timeout)))
+        if packed is None:
+            return None
+        return self._decode_results(packed)
+
+    def wait_complete_async(self, timeout=0, loop=None):
+        """ Same as ``wait_complete``, but returns an asyncio future.
+        The blocking call runs in the default executor of the loop, so the
+        event loop is never blocked.
+        """
+        try:
+            import asyncio
+        except ImportError:
+            import trollius as asyncio  # python 2 backport
+
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        return loop.run_in_executor(None, self.wait_complete, timeout)
+
+
+class DeltaAggregate(object):
+    """
+    Base class for aggregates whose updates are accumulated in memory as
+    deltas and applied on redis only when ``flush`` is called (i.e. in the
+    ``checkpoint`` of a categorizer).
+    Updates commute, so different workers can flush on the same key and
+    aggregates of the same type can be merged in process with ``merge``.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, key, redis_client=None):
+        self.key = key
+        self.redis_client = require_redis(redis_client,
+                                          type(self).__name__)
+        self.clear()
+
+    def __repr__(self):
+        return '<{0} "{1}">'.format(self.__class__.__name__, self.key)
+
+    @abstractmethod
+    def clear(self):
+        """ Drop the pending deltas """
+        pass
+
+    @abstractmethod
+    def pending(self):
+        """ Return True if there are deltas waiting to be flushed """
+        pass
+
+    @abstractmethod
+    def merge(self, other):
+        """ Add the pending deltas of ``other`` to this aggregate """
+        pass
+
+    @abstractmethod
+    def _queue(self, pipe):
+        """ Queue the commands applying the deltas on the pipeline """
+        pass
+
+    def flush(self, pipe=None):
+        """ Apply the pending deltas on redis.
+        If ``pipe`` is given the commands are only queued on it and it's up
+        to the caller to execute it, otherwise they are sent in a single
+        round trip.
+        """
+        if not self.pending():
+            return
+        execute = pipe is None
+        if execute:
+            pipe = self.redis_client.pipeline(transaction=False)
+        self._queue(pipe)
+        self.clear()
+        if execute:
+            pipe.execute()
+
+    def delete(self):
+        self.clear()
+        return self.redis_client.delete(self.key)
+
+
+def _to_number(value):
+    """ Parse a number returned by redis (HINCRBY / HINCRBYFLOAT) """
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def flush_all(*aggregates):
+    """ Flush many aggregates with a single pipeline (one round trip) for
+    each redis node they are stored on.
+    """
+    nodes = {}
+    for a in aggregates:
+        if a.pending():
+            nodes.setdefault(id(a.redis_client), []).append(a)
+    for pending in nodes.itervalues():
+        pipe = pending[0].redis_client.pipeline(transaction=False)
+        for a in pending:
+            a.flush(pipe)
+        pipe.execute()
+
+
+class CounterMap(DeltaAggregate):
+    """ A map of counters stored as a redis hash.
+
+    >>> c = CounterMap('WordCount:42')
+    >>> c.incr('foo')
+    >>> c.update(['foo', 'bar'])
+    >>> c.flush()  # HINCRBY WordCount:42 foo 2, HINCRBY WordCount:42 bar 1
+    """
+    def clear(self):
+        self.deltas = {}
+
+    def pending(self):
+        return bool(self.deltas)
+
+    def incr(self, field, amount=1):
+        self.deltas[field] = self.deltas.get(field, 0) + amount
+
+    def update(self, items):
+        """ Increment by one every field in ``items``, or by the given
+        amount if ``items`` is a dict.
+        """
+        if isinstance(items, dict):
+            for k, v in items.iteritems():
+                self.incr(k, v)
+        else:
+            for k in items:
+                self.incr(k)
+
+    def merge(self, other):
+        self.update(other.deltas)
+
+    def _queue(self, pipe):
+        for k, v in self.deltas.iteritems():
+            if isinstance(v, float):
+                pipe.hincrbyfloat(self.key, k, v)
+            elif v:
+                pipe.hincrby(self.key, k, v)
+
+    def get(self, field, default=0):
+        """ Return the stored value of ``field`` plus its pending delta """
+        res = self.redis_client.hget(self.key, field)
+        res = default if res is None else _to_number(res)
+        return res + self.deltas.get(field, 0)
+
+    def getall(self):
+        """ Return the stored counters (without the pending deltas) """
+        return {k: _to_number(v)
+                for k, v in self.redis_client.hgetall(self.key).iteritems()}
+
+
+class Sum(DeltaAggregate):
+    """ A number stored in a redis key, updated with INCRBYFLOAT """
+    def clear(self):
+        self.delta = 0
+
+    def pending(self):
+        return bool(self.delta)
+
+    def add(self, value):
+        self.delta += value
+
+    def merge(self, other):
+        self.add(other.delta)
+
+    def _queue(self, pipe):
+        pipe.incrbyfloat(self.key, self.delta)
+
+    def get(self):
+        """ Return the stored value plus the pending delta """
+        return float(self.redis_client.get(self.key) or 0) + self.delta
+
+
+class _Extreme(DeltaAggregate):
+    """ Common code for Min and Max: only the best value seen since the last
+    flush is kept, and a script replaces the stored one if it is beaten.
+    """
+    lua = None
+
+    def clear(self):
+        self.value = None
+
+    def pending(self):
+        return self.value is not None
+
+    @abstractmethod
+    def _better(self, a, b):
+        pass
+
+    def add(self, value):
+        if self.value is None or self._better(value, self.value):
+            self.value = value
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(other.value)
+
+    def _queue(self, pipe):
+        if not hasattr(self, '_script'):
+            self._script = self.redis_client.register_script(self.lua)
+        script = self._script
+        script(keys=[self.key], args=[repr(float(self.value))], client=pipe)
+
+    def get(self):
+        """ Return the best between the stored and the pending value """
+        stored = self.redis_client.get(self.key)
+        values = [v for v in (stored and float(stored), self.value)
+                  if v is not None]
+        if not values:
+            return None
+        return reduce(lambda a, b: a if self._better(a, b) else b, values)
+
+
+class Min(_Extreme):
+    lua = """
+    local cur = redis.call('GET', KEYS[1])
+    if not cur or tonumber(ARGV[1]) < tonumber(cur) then
+        redis.call('SET', KEYS[1], ARGV[1])
+    end
+    """
+
+    def _better(self, a, b):
+        return a < b
+
+
+class Max(_Extreme):
+    lua = """
+    local cur = redis.call('GET', KEYS[1])
+    if not cur or tonumber(ARGV[1]) > tonumber(cur) then
+        redis.call('SET', KEYS[1], ARGV[1])
+    end
+    """
+
+    def _better(self, a, b):
+        return a > b
+
+
+class Set(DeltaAggregate):
+    """ A set stored as a redis set; members are added with SADD """
+    def clear(self):
+        self.members = set()
+
+    def pending(self):
+        return bool(self.members)
+
+    def add(self, *members):
+        self.members.update(members)
+
+    def merge(self, other):
+        self.members |= other.members
+
+    def _queue(self, pipe):
+        pipe.sadd(self.key, *self.members)
+
+    def get(self):
+        """ Return the stored members plus the pending ones """
+        return self.redis_client.smembers(self.key) | self.members
+
+
+def _same_node(a, b):
+    """ Return True if two redis clients are connected to the same node """
+    return a is b or a.connection_pool.connection_kwargs == \
+        b.connection_pool.connection_kwargs
+
+
+class HyperLogLog(DeltaAggregate):
+    """ Approximate number of distinct members, stored as a redis
+    HyperLogLog (PFADD): at most 12 KB per key whatever the cardinality,
+    with a standard error of 0.81%.
+    Adding a member twice is harmless, so the pending members are flushed
+    as soon as they are ``max_pending``, and memory stays bounded.
+
+    >>> h = HyperLogLog('Visitors:42')
+    >>> h.update(['a', 'b', 'a'])
+    >>> h.count()
+    2
+    """
+    def __init__(self, key, redis_client=None, max_pending=10000):
+        self.max_pending = max_pending
+        super(HyperLogLog, self).__init__(key, redis_client)
+
+    def clear(self):
+        self.members = set()
+
+    def pending(self):
+        return bool(self.members)
+
+    def add(self, *members):
+        self.members.update(members)
+        if len(self.members) >= self.max_pending:
+            self.flush()
+
+    def update(self, members):
+        self.add(*members)
+
+    def merge(self, other):
+        self.add(*other.members)
+
+    def _queue(self, pipe):
+        pipe.pfadd(self.key, *self.members)
+
+    def count(self):
+        """ Return the estimated number of distinct members """
+        self.flush()
+        return self.redis_client.pfcount(self.key)
+
+    def merge_stored(self, *others):
+        """ Add the members of other HyperLogLogs (of other partitions or
+        streams, possibly on other nodes) to the stored one.
+        """
+        self.flush()
+        p = self.redis_client.pipeline()
+        sources, tmp = [self.key], []
+        for i, other in enumerate(others):
+            other.flush()
+            if _same_node(self.redis_client, other.redis_client):
+                sources.append(other.key)
+                continue
+            raw = other.redis_client.get(other.key)
+            if raw is not None:
+                tmp.append('{0}:merge:{1}'.format(self.key, i))
+                p.set(tmp[-1], raw)
+        p.pfmerge(self.key, *sources + tmp)
+        if tmp:
+            p.delete(*tmp)
+        p.execute()
+
+
+class CountMinSketch(DeltaAggregate):
+    """ Approximate count of each member of a multiset, and its ``topk``
+    most frequent members.
+    Counters are ``depth`` rows of ``width`` cells of a redis hash, so
+    memory does not depend on the number of distinct members: estimates
+    exceed the real count by at most 2N / width (N being the total count)
+    with probability 1 - 2^-depth. The top-k candidates are kept in the
+    sorted set <key>:topk, with their estimates.
+    Pending deltas are flushed as soon as they are ``max_pending``.
+
+    >>> c = CountMinSketch('WordFreq:42')
+    >>> c.update(['foo', 'bar', 'foo'])
+    >>> c.flush()
+    >>> c.get('foo'), c.top(1)
+    (2, [('foo', 2)])
+    """
+    # ARGV: depth, k, then member, count and the depth cells of each member
+    lua = """
+    local depth, k = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local i = 3
+    while i <= #ARGV do
+        local member, n = ARGV[i], tonumber(ARGV[i + 1])
+        local est
+        for d = 1, depth do
+            local v = redis.call('HINCRBY', KEYS[1], ARGV[i + 1 + d], n)
+            if not est or v < est then
+                est = v
+            end
+        end
+        if k > 0 and est > 0 then
+            redis.call('ZADD', KEYS[2], est, member)
+        end
+        i = i + 2 + depth
+    end
+    if k > 0 then
+        redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -k - 1)
+    end
+    """
+
+    def __init__(self, key, width=2048, depth=4, topk=100,
+                 redis_client=None, max_pending=10000):
+        self.width = width
+        self.depth = depth
+        self.topk = topk
+        self.max_pending = max_pending
+        self.topk_key = '{0}:topk'.format(key)
+        super(CountMinSketch, self).__init__(key, redis_client)
+
+    def clear(self):
+        self.deltas = {}
+
+    def pending(self):
+        return bool(self.deltas)
+
+    def _cells(self, member):
+        if isinstance(member, unicode):
+            member = member.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(str(member)).digest())
+        return [d * self.width + (h1 + d * h2) % self.width
+                for d in xrange(self.depth)]
+
+    def add(self, member, count=1):
+        self.deltas[member] = self.deltas.get(member, 0) + count
+        if len(self.deltas) >= self.max_pending:
+            self.flush()
+
+    def update(self, members):
+        """ Count every member in ``members``, or add the given count if
+        ``members`` is a dict.
+        """
+        if isinstance(members, dict):
+            for k, v in members.iteritems():
+                self.add(k, v)
+        else:
+            for k in members:
+                self.add(k)
+
+    def merge(self, other):
+        self.update(other.deltas)
+
+    def _script(self, pipe, deltas):
+        if not hasattr(self, '_lua'):
+            self._lua = self.redis_client.register_script(self.lua)
+        args = [self.depth, self.topk]
+        for member, n in deltas.iteritems():
+            args.append(member)
+            args.append(n)
+            args.extend(self._cells(member))
+        self._lua(keys=[self.key, self.topk_key], args=args, client=pipe)
+
+    def _queue(self, pipe):
+        self._script(pipe, self.deltas)
+
+    def get(self, member):
+        """ Return the estimated count of ``member`` (with its pending
+        delta).
+        """
+        values = self.redis_client.hmget(self.key, self._cells(member))
+        return min(int(v or 0) for v in values) + self.deltas.get(member, 0)
+
+    def top(self, n=None):
+        """ Return the (member, estimated count) of the most frequent
+        members, without the pending deltas.
+        """
+        n = self.topk if n is None else min(n, self.topk)
+        return [(m, int(c)) for m, c in self.redis_client.zrevrange(
+            self.topk_key, 0, n - 1, withscores=True)]
+
+    def merge_stored(self, *others):
+        """ Add the counts of other sketches with the same width and depth
+        (of other partitions or streams, possibly on other nodes) to the
+        stored ones.
+        """
+        self.flush()
+        p = self.redis_client.pipeline()
+        candidates = set(self.redis_client.zrange(self.topk_key, 0, -1))
+        for other in others:
+            if (other.width, other.depth) != (self.width, self.depth):
+                raise ValueError('{0} and {1} have different sizes'
+                                 .format(self, other))
+            other.flush()
+            for cell, v in other.redis_client.hgetall(other.key).iteritems():
+                p.hincrby(self.key, cell, int(v))
+            candidates.update(other.redis_client.zrange(other.topk_key,
+                                                        0, -1))
+        # refresh the estimates of the candidates to the top-k
+        self._script(p, dict.fromkeys(candidates, 0))
+        p.execute()
+
+    def delete(self):
+        self.clear()
+        return self.redis_client.delete(self.key, self.topk_key)
+
+
+class QuantileSketch(DeltaAggregate):
+    """ Approximate quantiles, with a relative error of at most
+    ``relative_accuracy`` (DDSketch).
+    Values are counted in logarithmic buckets of a redis hash, so memory
+    depends on the range of the values and not on their number (i.e.
+    about 2400 buckets from 1e-9 to 1e12 at 1%). Sketches with the same
+    accuracy are merged by adding their buckets.
+
+    >>> q = QuantileSketch('Latency:42')
+    >>> q.update([12.0, 15.5, 300])
+    >>> q.quantile(0.5)  # 15.5, with an error of at most 1%
+    """
+    def __init__(self, key, relative_accuracy=0.01, redis_client=None):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        super(QuantileSketch, self).__init__(key, redis_client)
+
+    def clear(self):
+        self.buckets = {}
+
+    def pending(self):
+        return bool(self.buckets)
+
+    def _bucket(self, value):
+        """ Name of the bucket of a value: p<i> for positive values, n<i>
+        for negative ones, z for zero.
+        """
+        if not value:
+            return 'z'
+        i = int(math.ceil(math.log(abs(value)) / self._log_gamma))
+        return '{0}{1}'.format('p' if value > 0 else 'n', i)
+
+    def _value(self, bucket):
+        """ Value represented by a bucket """
+        if bucket == 'z':
+            return 0.0
+        i = int(bucket[1:])
+        value = 2 * self.gamma ** i / (self.gamma + 1)
+        return value if bucket[0] == 'p' else -value
+
+    def add(self, value, count=1):
+        b = self._bucket(value)
+        self.buckets[b] = self.buckets.get(b, 0) + count
+
+    def update(self, values):
+        for v in values:
+            self.add(v)
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('{0} and {1} have different accuracies'
+                             .format(self, other))
+        for b, n in other.buckets.iteritems():
+            self.buckets[b] = self.buckets.get(b, 0) + n
+
+    def _queue(self, pipe):
+        for b, n in self.buckets.iteritems():
+            pipe.hincrby(self.key, b, n)
+
+    def _all_buckets(self):
+        res = dict((b, int(n)) for b, n in
+                   self.redis_client.hgetall(self.key).iteritems())
+        for b, n in self.buckets.iteritems():
+            res[b] = res.get(b, 0) + n
+        return res
+
+    def count(self):
+        """ Return the number of values (with the pending ones) """
+        return sum(self._all_buckets().itervalues())
+
+    def quantiles(self, qs):
+        """ Return the estimated quantiles ``qs`` (between 0 and 1) of the
+        values, with the pending ones, or None if there are no values.
+        """
+        buckets = sorted((self._value(b), n)
+                         for b, n in self._all_buckets().iteritems() if n)
+        total = sum(n for _, n in buckets)
+        if not total:
+            return [None for _ in qs]
+
+        res = []
+        for q in qs:
+            rank, seen = q * (total - 1), 0
+            for value, n in buckets:
+                seen += n
+                if seen > rank:
+                    res.append(value)
+                    break
+        return res
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+    def merge_stored(self, *others):
+        """ Add the buckets of other sketches with the same accuracy (of
+        other partitions or streams, possibly on other nodes) to the stored
+        ones.
+        """
+        self.flush()
+        p = self.redis_client.pipeline(transaction=False)
+        for other in others:
+            if other.relative_accuracy != self.relative_accuracy:
+                raise ValueError('{0} and {1} have different accuracies'
+                                 .format(self, other))
+            other.flush()
+            for b, n in other.redis_client.hgetall(other.key).iteritems():
+                p.hincrby(self.key, b, int(n))
+        p.execute()
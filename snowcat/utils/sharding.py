@@ -0,0 +1,241 @@
+"""
+Sharding of the snowcat state across many redis instances.
+
+All the keys of a stream (locks, PersistentObjects, SimpleKV, finished
+flags, polls...) live on the same node, chosen by consistent hashing of its
+auth_id: scripts and pipelines on the keys of a stream keep working, and
+adding a node moves only a fraction of the streams.
+Global keys (i.e. ``snowcat_debug``, ``snowcat:activity``) live on the first
+node.
+
+Nodes are configured with ``configure`` or with the SNOWCAT_REDIS_NODES
+environment variable (comma separated redis URLs). With no configuration
+a single node, redis.StrictRedis(), is used.
+
+Objects holding keys of a stream (PersistentObject, PollValue, the
+aggregates of redis_utils) must be given the client of its node, i.e.
+``get_redis(auth_id)``, when there are many nodes (see ``require_redis``).
+
+When the nodes change, streams are moved with the rebalancing tool
+(workers must be stopped). The categorizer names of the app, and any other
+prefix preceding an auth_id in keys, must be known to find the stream of
+each key:
+
+    python -m snowcat.utils.sharding --from redis://a,redis://b \\
+        --to redis://a,redis://b,redis://c --app myapp:celeryapp \\
+        --prefix WordCount
+"""
+import bisect
+import hashlib
+import os
+import redis
+
+DEFAULT_REPLICAS = 128
+
+
+def _hash(value):
+    return int(hashlib.md5(str(value)).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """ Consistent hashing of auth_ids on nodes, with ``replicas`` virtual
+    nodes for each node.
+    """
+    def __init__(self, nodes, replicas=DEFAULT_REPLICAS):
+        if not nodes:
+            raise ValueError('at least one node is needed')
+        self.nodes = list(nodes)
+        self.replicas = replicas
+
+        ring = sorted((_hash('{0}#{1}'.format(node, i)), node)
+                      for node in self.nodes for i in xrange(replicas))
+        self._hashes = [h for h, _ in ring]
+        self._nodes = [n for _, n in ring]
+
+    def __repr__(self):
+        return '<HashRing {0}>'.format(self.nodes)
+
+    def node(self, auth_id):
+        """ Return the node of a stream """
+        i = bisect.bisect(self._hashes, _hash(auth_id)) % len(self._hashes)
+        return self._nodes[i]
+
+
+class ShardedRedis(object):
+    """ Redis clients of the nodes, and the ring that maps streams on them
+    """
+    def __init__(self, nodes=None, replicas=DEFAULT_REPLICAS):
+        """
+        :param nodes: list of redis URLs; None to use redis.StrictRedis().
+        """
+        self._clients = {}
+        if not nodes:
+            self.ring = None
+            self._default = redis.StrictRedis()
+        else:
+            self.ring = HashRing(nodes, replicas)
+            self._default = self.client(nodes[0])
+
+    def __repr__(self):
+        return '<ShardedRedis {0}>'.format(self.ring)
+
+    def client(self, node):
+        if node not in self._clients:
+            self._clients[node] = redis.StrictRedis.from_url(node)
+        return self._clients[node]
+
+    def node(self, auth_id):
+        return self.ring.node(auth_id) if self.ring is not None else None
+
+    def get(self, auth_id=None):
+        """ Return the client of the node of a stream, or of the first node
+        if auth_id is None.
+        """
+        if auth_id is None or self.ring is None:
+            return self._default
+        return self.client(self.ring.node(auth_id))
+
+    def all(self):
+        """ Return the clients of all the nodes """
+        if self.ring is None:
+            return [self._default]
+        return [self.client(n) for n in self.ring.nodes]
+
+
+_sharded = None
+
+
+def configure(nodes=None, replicas=DEFAULT_REPLICAS):
+    """ Set the redis nodes used by snowcat (a list of redis URLs) """
+    global _sharded
+    _sharded = ShardedRedis(nodes, replicas)
+    return _sharded
+
+
+def _get_sharded():
+    if _sharded is None:
+        nodes = os.environ.get('SNOWCAT_REDIS_NODES')
+        configure([n.strip() for n in nodes.split(',')] if nodes else None)
+    return _sharded
+
+
+def get_redis(auth_id=None):
+    """ Return the redis client holding the keys of stream ``auth_id``
+    (the first node when auth_id is None).
+    """
+    return _get_sharded().get(auth_id)
+
+
+def all_redis():
+    """ Return the redis clients of all the nodes """
+    return _get_sharded().all()
+
+
+def require_redis(redis_client, what):
+    """ Return ``redis_client``, or the only node if it is None.
+    With many nodes there is no sensible default: the keys would end up on
+    the first node instead of the node of their stream, so a ValueError is
+    raised.
+    :param what: description of the caller, for the error message.
+    """
+    if redis_client is not None:
+        return redis_client
+    sharded = _get_sharded()
+    if sharded.ring is not None and len(sharded.ring.nodes) > 1:
+        raise ValueError('{0} needs a redis_client with many redis nodes '
+                         '(i.e. get_redis(auth_id))'.format(what))
+    return sharded.get()
+
+
+def key_stream(key, prefixes):
+    """ Return the auth_id of a snowcat key, or None for global keys.
+    Keys are formatted as ``<auth_id>:...`` or ``<prefix>:<auth_id>:...``,
+    where prefix is a categorizer name or another known prefix.
+    """
+    if key.startswith('snowcat'):
+        return None
+    parts = key.split(':')
+    if parts[0] in prefixes:
+        return parts[1] if len(parts) > 1 else None
+    return parts[0] if len(parts) > 1 else None
+
+
+def rebalance(old_nodes, new_nodes, prefixes=(), replicas=DEFAULT_REPLICAS,
+              dry_run=False, batch=500):
+    """ Move the keys of each stream to its node in ``new_nodes``.
+    Keys are copied with DUMP / RESTORE, keeping their TTL, and then
+    deleted from the old node. Global keys stay where they are.
+    Workers must be stopped while rebalancing.
+    :param prefixes: the prefixes that may precede an auth_id in keys:
+     categorizer names and any other prefix used by categorizers. Required:
+     without them the prefix of a key would be taken as its auth_id.
+    :return: the number of moved keys.
+    """
+    if not prefixes:
+        raise ValueError('the key prefixes (i.e. the categorizer names) are '
+                         'needed to find the stream of each key')
+    old = ShardedRedis(old_nodes, replicas)
+    new = ShardedRedis(new_nodes, replicas)
+    prefixes = set(prefixes)
+
+    moved = 0
+    for node in old.ring.nodes:
+        src = old.client(node)
+        for key in src.scan_iter(count=batch):
+            auth_id = key_stream(key, prefixes)
+            if auth_id is None:
+                continue
+            target = new.ring.node(auth_id)
+            if target == node:
+                continue
+
+            moved += 1
+            if dry_run:
+                continue
+
+            p = src.pipeline(transaction=False)
+            p.dump(key)
+            p.pttl(key)
+            value, ttl = p.execute()
+            if value is None:  # expired in the meantime
+                continue
+            new.client(target).execute_command(
+                'RESTORE', key, max(ttl, 0), value, 'REPLACE')
+            src.delete(key)
+    return moved
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Move the snowcat keys after changing the redis nodes.')
+    parser.add_argument('--from', dest='old', required=True,
+                        help='comma separated URLs of the current nodes')
+    parser.add_argument('--to', dest='new', required=True,
+                        help='comma separated URLs of the new nodes')
+    parser.add_argument('--prefix', action='append', default=[],
+                        help='key prefix followed by an auth_id '
+                             '(i.e. a categorizer name); repeatable')
+    parser.add_argument('--app', help='celery app (module:attribute), to '
+                                      'use its categorizer names as prefixes')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args(argv)
+
+    prefixes = list(args.prefix)
+    if args.app:
+        from importlib import import_module
+        from snowcat.categorizers import get_all_categorizers
+        module, attr = args.app.split(':')
+        app = getattr(import_module(module), attr)
+        prefixes.extend(c.name for c in get_all_categorizers(app))
+    if not prefixes:
+        parser.error('--app or --prefix is required')
+
+    moved = rebalance(args.old.split(','), args.new.split(','),
+                      prefixes=prefixes, dry_run=args.dry_run)
+    print '{0} keys {1}'.format(moved, 'to move' if args.dry_run else 'moved')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+"""
+State store for categorizers whose state doesn't fit in memory.
+
+PersistentObject keeps the whole state in memory and saves it to redis as a
+single value. SpillableObject is used in its place when some attributes of
+the state are large dicts (i.e. a counter for each word): each of them is a
+SpillDict, which keeps the most recently used items in memory and the
+others in a local sqlite database. The whole state is saved in the
+database, in a single transaction; redis only holds a small manifest.
+
+The database lives next to the queues of the stream, so it is removed with
+them when the stream is finalized.
+
+A state may be used by more than one thread (AsyncLoopCategorizer loads
+and saves it in I/O threads, and runs ``process`` on the event loop
+thread): the connection is shared, and every access to the database and to
+the in-memory items goes through a lock.
+"""
+import os
+import sqlite3
+import threading
+from collections import MutableMapping, OrderedDict
+from copy import deepcopy
+import msgpack
+from sharding import require_redis
+
+
+class StateMissing(RuntimeError):
+    """ The database of a state is older than its manifest (i.e. it was
+    deleted, or the stream has moved to another host).
+    """
+    pass
+
+
+def _pack(value):
+    return sqlite3.Binary(msgpack.dumps(value))
+
+
+def _unpack(blob):
+    return msgpack.loads(str(blob))
+
+
+class SpillDict(MutableMapping):
+    """
+    A dict keeping at most ``max_items`` items in memory; the least recently
+    used ones are moved to the database. Changes reach the database at
+    ``flush`` or when items are evicted, and are durable once the database
+    is committed (see SpillableObject.save).
+    Values are copied when they are evicted: mutable values (lists, dicts)
+    read from the dict are considered modified.
+    """
+    def __init__(self, conn, name, max_items=100000, lock=None):
+        """
+        :param lock: lock serializing the accesses to ``conn``.
+        """
+        self.conn = conn
+        self.name = name
+        self.max_items = max_items
+        self.lock = lock if lock is not None else threading.RLock()
+
+        self._hot = OrderedDict()
+        self._dirty = set()
+        self._deleted = set()
+        with self.lock:
+            self._len = conn.execute(
+                'SELECT COUNT(*) FROM items WHERE name = ?',
+                (name,)).fetchone()[0]
+
+    def __repr__(self):
+        return '<SpillDict {0}: {1} items, {2} in memory>'.format(
+            self.name, len(self), len(self._hot))
+
+    def _load(self, key):
+        """ Return the value of a key from the database, or raise KeyError """
+        if key in self._deleted:
+            raise KeyError(key)
+        row = self.conn.execute(
+            'SELECT value FROM items WHERE name = ? AND key = ?',
+            (self.name, _pack(key))).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return _unpack(row[0])
+
+    def _evict(self):
+        evicted = []
+        while len(self._hot) > self.max_items:
+            key, value = self._hot.popitem(last=False)
+            if key in self._dirty:
+                self._dirty.discard(key)
+                evicted.append((self.name, _pack(key), _pack(value)))
+        if evicted:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO items VALUES (?, ?, ?)', evicted)
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self._hot:
+                value = self._hot.pop(key)
+            else:
+                value = self._load(key)
+            self._hot[key] = value
+            if isinstance(value, (list, dict)):
+                self._dirty.add(key)
+            self._evict()
+            return value
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self._hot:
+                return True
+            try:
+                self._load(key)
+            except KeyError:
+                return False
+            return True
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key not in self:
+                self._len += 1
+            self._hot.pop(key, None)
+            self._hot[key] = value
+            self._dirty.add(key)
+            self._deleted.discard(key)
+            self._evict()
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+            self._hot.pop(key, None)
+            self._dirty.discard(key)
+            self._deleted.add(key)
+            self._len -= 1
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        with self.lock:
+            self.flush()
+            rows = self.conn.execute('SELECT key FROM items WHERE name = ?',
+                                     (self.name,)).fetchall()
+        for row in rows:
+            yield _unpack(row[0])
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM items WHERE name = ?',
+                              (self.name,))
+            self._hot.clear()
+            self._dirty.clear()
+            self._deleted.clear()
+            self._len = 0
+
+    def flush(self):
+        """ Write the modified items to the database (without committing) """
+        with self.lock:
+            if self._deleted:
+                self.conn.executemany(
+                    'DELETE FROM items WHERE name = ? AND key = ?',
+                    [(self.name, _pack(k)) for k in self._deleted])
+                self._deleted.clear()
+            if self._dirty:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO items VALUES (?, ?, ?)',
+                    [(self.name, _pack(k), _pack(self._hot[k]))
+                     for k in self._dirty])
+                self._dirty.clear()
+
+
+class SpillableObject(object):
+    """
+    Drop-in replacement of PersistentObject for large states. The
+    attributes listed in ``spill`` are SpillDicts; all the state is stored
+    in the sqlite database at ``path``, while redis holds a manifest with
+    the path of the database, the number of saves and the size of each
+    SpillDict.
+    """
+    def __init__(self, namespace, path, default=None, spill=(),
+                 max_items=100000, redis_client=None):
+        """
+        :param default: default state; the defaults of the attributes in
+         ``spill`` must be dicts.
+        :param max_items: items of each SpillDict kept in memory.
+        """
+        if default is None:
+            default = {}
+        redis_client = require_redis(redis_client, 'SpillableObject')
+        object.__setattr__(self, 'namespace', namespace)
+        object.__setattr__(self, 'path', path)
+        object.__setattr__(self, 'spill', tuple(spill))
+        object.__setattr__(self, 'max_items', max_items)
+        object.__setattr__(self, 'attrs', deepcopy(default))
+        object.__setattr__(self, 'redis_client', redis_client)
+        object.__setattr__(self, '_gen', 0)
+        object.__setattr__(self, 'lock', threading.RLock())
+
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute('CREATE TABLE IF NOT EXISTS items ('
+                     'name TEXT, key BLOB, value BLOB, '
+                     'PRIMARY KEY (name, key))')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                     'key TEXT PRIMARY KEY, value BLOB)')
+        conn.commit()
+        object.__setattr__(self, 'conn', conn)
+
+        self.load()
+
+    def __getattr__(self, item):
+        attrs = object.__getattribute__(self, 'attrs')
+        if item in attrs:
+            return attrs[item]
+        return object.__getattribute__(self, item)
+
+    def __setattr__(self, key, value):
+        if key in self.spill:
+            if value is self.attrs[key]:
+                return
+            # keep the SpillDict, replacing its content
+            self.attrs[key].clear()
+            self.attrs[key].update(value)
+        else:
+            self.attrs[key] = value
+
+    def __repr__(self):
+        return repr(self.attrs)
+
+    def __str__(self):
+        return str(self.attrs)
+
+    @property
+    def _redis_ns(self):
+        """ Generate the redis key of the manifest """
+        return '{0}:SpillableObject'.format(self.namespace)
+
+    def _meta(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?',
+                                    (key,)).fetchone()
+        return _unpack(row[0]) if row is not None else None
+
+    def load(self):
+        """ Load the state from the database, checking it against the
+        manifest.
+        """
+        serialized = self.redis_client.get(self._redis_ns)
+        manifest = msgpack.loads(serialized) if serialized else None
+
+        gen = self._meta('gen') or 0
+        if manifest is not None and gen < manifest['gen']:
+            raise StateMissing(
+                'the state of {0} in {1} is older than its manifest'
+                .format(self.namespace, self.path))
+
+        fresh = not gen
+        if not fresh:
+            self.attrs.update(self._meta('attrs') or {})
+        object.__setattr__(self, '_gen', gen)
+
+        for name in self.spill:
+            default = self.attrs.get(name) or {}
+            self.attrs[name] = SpillDict(self.conn, name, self.max_items,
+                                         self.lock)
+            if fresh and default:
+                self.attrs[name].update(default)
+
+    def save(self, pipe=None):
+        """ Commit the state to the database and write the manifest to
+        redis, or queue the write on a pipeline.
+        """
+        gen = self._gen + 1
+        plain = dict((k, v) for k, v in self.attrs.iteritems()
+                     if k not in self.spill)
+        with self.lock:
+            for name in self.spill:
+                self.attrs[name].flush()
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                [('gen', _pack(gen)), ('attrs', _pack(plain))])
+            self.conn.commit()
+        object.__setattr__(self, '_gen', gen)
+
+        manifest = {
+            'path': self.path,
+            'gen': gen,
+            'sizes': dict((n, len(self.attrs[n])) for n in self.spill),
+        }
+        client = self.redis_client if pipe is None else pipe
+        client.set(self._redis_ns, msgpack.dumps(manifest))
+
+    def get(self, attr, default=None):
+        """ SO.get(k[,d]) -> D[k] if k in SO, else d.  d defaults to None. """
+        if attr in self.attrs:
+            return self.attrs[attr]
+        return default
+
+    def getall(self):
+        return self.attrs
+
+    def exists(self, k):
+        return k in self.attrs
+
+    def delete(self):
+        """ Delete the state, both from redis and from the database """
+        with self.lock:
+            self.conn.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        object.__setattr__(self, 'attrs', {})
+        return self.redis_client.delete(self._redis_ns)
@@ -0,0 +1,242 @@
+from collections import deque
+
+
+class Window(object):
+    """
+    Base class for windowed state operators.
+    A window is a view over a plain dict (its state), which is updated in
+    place: storing the dict in a PersistentObject (see
+    ``LoopCategorizer.window``) is enough to persist the window.
+    Aggregates are updated incrementally, so pushing an item costs O(1).
+    """
+    def __init__(self, state, value=None):
+        """
+        :param state: dict holding the state of the window. Empty dicts are
+         initialized.
+        :param value: function extracting the value to aggregate from an
+         item. Defaults to the item itself.
+        """
+        self.state = state
+        self.value = value if value is not None else lambda item: item
+        if not state:
+            self.state.update(self.initial_state())
+
+    def initial_state(self):
+        return {}
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(self.__class__.__name__, self.aggregates())
+
+    @property
+    def count(self):
+        return self.state['count']
+
+    @property
+    def sum(self):
+        return self.state['sum']
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return float(self.sum) / self.count
+
+    @property
+    def min(self):
+        return self.state['min']
+
+    @property
+    def max(self):
+        return self.state['max']
+
+    def aggregates(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.mean,
+            'min': self.min,
+            'max': self.max,
+        }
+
+
+class _AccumulatingWindow(Window):
+    """ A window which doesn't keep its items, only their aggregates. """
+    def initial_state(self):
+        return {'count': 0, 'sum': 0, 'min': None, 'max': None}
+
+    def _reset(self):
+        self.state.update(_AccumulatingWindow.initial_state(self))
+
+    def _accumulate(self, v):
+        s = self.state
+        s['count'] += 1
+        s['sum'] += v
+        if s['min'] is None or v < s['min']:
+            s['min'] = v
+        if s['max'] is None or v > s['max']:
+            s['max'] = v
+
+    def close(self):
+        """ Close the current window and return its aggregates,
+        or None if it is empty.
+        """
+        if not self.count:
+            return None
+        res = self.aggregates()
+        self._reset()
+        return res
+
+
+class TumblingWindow(_AccumulatingWindow):
+    """ Fixed size, non overlapping windows of ``size`` items.
+
+    >>> w = TumblingWindow({}, 2)
+    >>> w.push(1)
+    >>> w.push(3)
+    {'count': 2, 'sum': 4, 'mean': 2.0, 'min': 1, 'max': 3}
+    """
+    def __init__(self, state, size, value=None):
+        self.size = size
+        super(TumblingWindow, self).__init__(state, value)
+
+    def push(self, item):
+        """ Add an item to the window.
+        Return the aggregates of the window if it is full, None otherwise.
+        """
+        self._accumulate(self.value(item))
+        if self.count >= self.size:
+            return self.close()
+        return None
+
+
+class SessionWindow(_AccumulatingWindow):
+    """ Windows of items separated by less than ``gap`` (i.e. seconds). """
+    def __init__(self, state, gap, value=None):
+        self.gap = gap
+        super(SessionWindow, self).__init__(state, value)
+
+    def initial_state(self):
+        res = super(SessionWindow, self).initial_state()
+        res.update({'start': None, 'last': None})
+        return res
+
+    def _reset(self):
+        super(SessionWindow, self)._reset()
+        self.state.update({'start': None, 'last': None})
+
+    def aggregates(self):
+        res = super(SessionWindow, self).aggregates()
+        res.update({'start': self.state['start'], 'end': self.state['last']})
+        return res
+
+    def push(self, ts, item):
+        """ Add an item, happened at time ``ts``, to the session.
+        Return the aggregates of the previous session if the item opened a
+        new one, None otherwise.
+        """
+        res = None
+        last = self.state['last']
+        if last is not None and ts - last > self.gap:
+            res = self.close()
+
+        if self.state['start'] is None:
+            self.state['start'] = ts
+        self.state['last'] = ts
+        self._accumulate(self.value(item))
+        return res
+
+
+class SlidingWindow(Window):
+    """ The last ``size`` items, kept in a ring buffer.
+    Min and max are maintained with monotonic queues, which are rebuilt from
+    the ring buffer when the window is loaded and not persisted.
+    If ``aggregate`` is False the window is a plain ring buffer, useful for
+    non numeric items.
+    The size is stored in the state: a state loaded with a different size is
+    resized, keeping its newest items.
+    """
+    def __init__(self, state, size, value=None, aggregate=True):
+        self.size = size
+        self.aggregate = aggregate
+        super(SlidingWindow, self).__init__(state, value)
+        if self.state.get('size') != size:
+            self._resize()
+
+        self._mins = deque()
+        self._maxs = deque()
+        if self.aggregate:
+            first = self.state['n'] - len(self.state['items'])
+            for seq, item in enumerate(self, first):
+                self._push_extremes(seq, self.value(item))
+
+    def initial_state(self):
+        return {'items': [], 'head': 0, 'n': 0, 'sum': 0, 'size': self.size}
+
+    def _resize(self):
+        """ Rebuild the ring buffer of a state saved with another size """
+        items = list(self)[-self.size:]
+        self.state.update({'items': items, 'head': 0, 'size': self.size})
+        if self.aggregate:
+            self.state['sum'] = sum(self.value(item) for item in items)
+
+    def __iter__(self):
+        """ Iterate over the items, from the oldest to the newest """
+        items, head = self.state['items'], self.state['head']
+        for i in xrange(len(items)):
+            yield items[(head + i) % len(items)]
+
+    def __len__(self):
+        return len(self.state['items'])
+
+    def items(self):
+        return list(self)
+
+    def _push_extremes(self, seq, v):
+        while self._mins and self._mins[-1][1] >= v:
+            self._mins.pop()
+        self._mins.append((seq, v))
+        while self._maxs and self._maxs[-1][1] <= v:
+            self._maxs.pop()
+        self._maxs.append((seq, v))
+
+        oldest = seq - self.size
+        while self._mins[0][0] <= oldest:
+            self._mins.popleft()
+        while self._maxs[0][0] <= oldest:
+            self._maxs.popleft()
+
+    def push(self, item):
+        """ Add an item to the window.
+        Return the evicted item, or None if the window was not full.
+        """
+        s = self.state
+        evicted = None
+        full = len(s['items']) >= self.size
+        if not full:
+            s['items'].append(item)
+        else:
+            evicted = s['items'][s['head']]
+            s['items'][s['head']] = item
+            s['head'] = (s['head'] + 1) % self.size
+
+        if self.aggregate:
+            v = self.value(item)
+            s['sum'] += v
+            if full:
+                s['sum'] -= self.value(evicted)
+            self._push_extremes(s['n'], v)
+
+        s['n'] += 1
+        return evicted
+
+    @property
+    def count(self):
+        return len(self)
+
+    @property
+    def min(self):
+        return self._mins[0][1] if self._mins else None
+
+    @property
+    def max(self):
+        return self._maxs[0][1] if self._maxs else None
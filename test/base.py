@@ -0,0 +1,56 @@
+"""
+Base test case for the tests which need redis and a celery app.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import redis
+from celery import Celery
+
+import snowcat.tasks  # noqa: registers the snowcat tasks in every app
+from snowcat.categorizers import LoopCategorizer
+from snowcat.utils import sharding
+
+# redis database used (and flushed) by the tests
+TEST_NODE = os.environ.get('SNOWCAT_TEST_REDIS_NODES',
+                           'redis://localhost/13').split(',')[0]
+
+
+class RedisTestCase(unittest.TestCase):
+    """ Run snowcat on TEST_NODE, with an eager celery app and queues in a
+    temporary directory. Skipped when no redis server is reachable.
+    """
+    def setUp(self):
+        self.redis = sharding.configure([TEST_NODE]).get()
+        try:
+            self.redis.flushdb()
+        except redis.ConnectionError:
+            sharding.configure()
+            self.skipTest('no redis server')
+
+        self.fs_prefix = tempfile.mkdtemp()
+        self.app = Celery('test', set_as_current=False)
+        self.app.conf.CELERY_ALWAYS_EAGER = True
+
+    def tearDown(self):
+        self.redis.flushdb()
+        sharding.configure()
+        shutil.rmtree(self.fs_prefix)
+
+    def categorizer(self, name, base=LoopCategorizer, **attrs):
+        """ Define a categorizer registered in the app of the test only,
+        and return its task.
+        """
+        attrs.update(name=name, autoregister=False, _app=self.app,
+                     FSQUEUE_PREFIX=self.fs_prefix)
+        attrs.setdefault('INPUT_QUEUE', 'Stream')
+        attrs.setdefault('checkpoint', lambda self, auth_id: None)
+        self.app.tasks.register(type(base)(name, (base,), attrs))
+        return self.app.tasks[name]
+
+    def write(self, auth_id, items, queue='Stream'):
+        """ Append a chunk to a queue of a stream """
+        LoopCategorizer.save_chunk_fs(
+            items, os.path.join(self.fs_prefix, auth_id, queue, 'queue'))
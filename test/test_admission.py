@@ -0,0 +1,75 @@
+import unittest
+
+from snowcat.admission import AdmissionControl, DelayIngestion, ShedLoad
+
+from test.base import RedisTestCase
+
+
+class AdmissionControlTest(RedisTestCase):
+    def setUp(self):
+        super(AdmissionControlTest, self).setUp()
+        self.a = self.categorizer('A', process=lambda self, u, item: None)
+        self.admission = AdmissionControl(
+            self.app, fs_prefix=self.fs_prefix, stream_lag_delay=10,
+            stream_lag_shed=20, min_free_disk_delay=None,
+            min_free_disk_shed=None)
+
+    def test_stream_lag(self):
+        self.write('u', range(5))
+        self.assertEqual(self.admission.check('u'), ('accept', None))
+        self.a.run('u')
+        self.write('u', range(15))
+        self.assertEqual(self.admission.check('u'),
+                         ('delay', 'stream lag is 15'))
+        self.write('u', range(15))
+        self.assertEqual(self.admission.check('u'),
+                         ('shed', 'stream lag is 30'))
+        self.a.run('u')
+        self.assertEqual(self.admission.check('u'), ('accept', None))
+
+    def test_admit(self):
+        self.a.run('u')
+        self.write('u', range(15))
+        self.assertRaises(DelayIngestion, self.admission.admit, 'u')
+        self.admission.admit('u', shed_only=True)
+        self.write('u', range(15))
+        self.assertRaises(ShedLoad, self.admission.admit, 'u')
+        self.assertEqual(self.admission.global_metrics(),
+                         {'accept': 1, 'delay': 1, 'shed': 1})
+
+    def test_shed_only_skips_lag(self):
+        self.admission.stream_lag_shed = None
+        lags = []
+        self.admission.stream_lag = lags.append
+        self.assertEqual(self.admission.check('u', shed_only=True),
+                         ('accept', None))
+        self.assertEqual(lags, [])
+
+    def test_free_disk(self):
+        self.admission.min_free_disk_delay = 1.0
+        self.assertEqual(self.admission.check('u')[0], 'delay')
+        self.admission.min_free_disk_shed = 1.0
+        self.admission._stats = None
+        self.assertEqual(self.admission.check('u')[0], 'shed')
+
+    def test_finished_categorizer(self):
+        """ A categorizer which called finalize is not taken into account,
+        even if it goes on after finalizing.
+        """
+        def process(self, auth_id, item):
+            if item == 'end':
+                self.finalize(auth_id)
+
+        a = self.categorizer('Finishing', process=process)
+        self.write('u', [1, 'end', 2])
+        a.run('u')
+        self.a.run('u')
+        self.assertIsNone(self.redis.hget('u:progress', 'Finishing'))
+
+        self.write('u', range(30000))
+        self.a.run('u')
+        self.assertEqual(self.admission.check('u'), ('accept', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
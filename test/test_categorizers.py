@@ -0,0 +1,171 @@
+import unittest
+
+import redis
+
+from snowcat.core import Topology
+
+from test.base import RedisTestCase
+
+
+class FusionTest(RedisTestCase):
+    def setUp(self):
+        super(FusionTest, self).setUp()
+        self.seen = []
+        self.crash_on = None
+
+        def process_parent(cat, auth_id, item):
+            if item == self.crash_on:
+                raise RuntimeError('crash')
+            cat.emit('Mid', item)
+
+        self.parent = self.categorizer('Parent', process=process_parent,
+                                       EMIT_CHUNK_SIZE=2)
+        self.child = self.categorizer(
+            'Child', INPUT_QUEUE='Mid', DEPENDENCIES=['Parent'],
+            process=lambda cat, auth_id, item: self.seen.append(item))
+
+    def fuse(self, fuse):
+        self.child.FUSE = fuse
+        self.parent._fused_children = None
+
+    def test_fused(self):
+        self.fuse(True)
+        self.write('u', range(3))
+        self.parent.run('u')
+        self.assertEqual(self.seen, range(3))
+        self.assertEqual(self.child.queue_index('u').total_items(), 0)
+
+    def test_replay(self):
+        """ Items written by the parent before a crash are processed once
+        when the parent replays them fused, and the next items emitted
+        unfused are not skipped.
+        """
+        self.write('u', range(5))
+        self.crash_on = 3  # after a chunk of 2 items is written
+        self.parent.run('u')
+        self.assertEqual(self.seen, [])
+        self.assertEqual(self.child.queue_index('u').total_items(), 2)
+
+        self.crash_on = None
+        self.fuse(True)
+        self.parent.run('u')
+        self.assertEqual(self.seen, range(5))
+
+        self.fuse(False)
+        self.write('u', [5, 6])
+        self.parent.run('u')
+        self.assertEqual(self.seen, range(7))
+
+    def test_spill_state(self):
+        self.fuse(True)
+        self.child.SPILL_STATE = ('counts',)
+        self.assertEqual(
+            Topology('test', self.app).errors(),
+            ['Child can\'t be fused: categorizers with SPILL_STATE can\'t be '
+             'fused'])
+        self.assertEqual(self.parent.fused_children, [])
+
+
+class CoalesceTest(RedisTestCase):
+    def setUp(self):
+        super(CoalesceTest, self).setUp()
+        self.seen = []
+        self.cat = self.categorizer(
+            'C', COALESCE=2,
+            process=lambda cat, auth_id, item:
+                self.seen.append((auth_id, item)))
+        self.scheduled = []
+        self.coalesced = self.app.tasks['RunCoalesced']
+        self.coalesced.apply_async = \
+            lambda args, countdown: self.scheduled.append(countdown)
+
+    def ready(self):
+        return self.redis.zrange(self.cat.ready_key(), 0, -1)
+
+    def test_mark_claim(self):
+        for auth_id in 'abca':
+            self.cat.mark_ready(auth_id)
+        self.assertEqual(self.ready(), ['a', 'b', 'c'])
+        self.assertEqual(self.scheduled, [self.cat.COALESCE_DELAY])
+
+        self.assertEqual(self.cat.claim_ready(), ['a', 'b'])
+        self.assertEqual(self.scheduled, [self.cat.COALESCE_DELAY, 0])
+        self.assertEqual(self.cat.claim_ready(), ['c'])
+        self.assertEqual(self.cat.claim_ready(), [])
+        self.assertEqual(len(self.scheduled), 2)
+
+    def test_run_batch(self):
+        self.write('a', [1, 2])
+        self.write('b', [3])
+        self.cat.run_if_not_already_running('a')
+        self.cat.run_if_not_already_running('b')
+        self.assertEqual(self.seen, [])
+
+        self.assertEqual(self.coalesced.run('C'), 2)
+        self.assertEqual(self.seen, [('a', 1), ('a', 2), ('b', 3)])
+        self.assertEqual(self.redis.keys('C:*:lock'), [])
+        self.assertEqual(self.redis.hget('a:progress', 'C'), '2')
+        self.assertEqual(self.ready(), [])
+
+        self.write('a', [4])
+        self.cat.mark_ready('a')
+        self.coalesced.run('C')
+        self.assertEqual(self.seen[-1], ('a', 4))
+
+    def test_leftovers(self):
+        """ Data arriving during the run gets the stream marked again """
+        self.cat.post_run = lambda auth_id: self.write(auth_id, ['late'])
+        try:
+            self.write('a', [1])
+            self.cat.mark_ready('a')
+            self.coalesced.run('C')
+        finally:
+            del self.cat.post_run
+        self.assertEqual(self.seen, [('a', 1)])
+        self.assertEqual(self.ready(), ['a'])
+
+        self.coalesced.run('C')
+        self.assertEqual(self.seen, [('a', 1), ('a', 'late')])
+
+    def test_commit_error(self):
+        """ The locks are released and the streams marked again if the
+        states can't be committed
+        """
+        pipeline = self.redis.pipeline
+
+        def failing_pipeline(transaction=True, **kwargs):
+            p = pipeline(transaction=transaction, **kwargs)
+            if transaction:
+                def execute(*args, **kwargs):
+                    raise redis.ConnectionError('down')
+                p.execute = execute
+            return p
+
+        claim_ready = self.cat.claim_ready
+
+        def claim_and_fail():
+            auth_ids = claim_ready()
+            self.redis.pipeline = failing_pipeline
+            return auth_ids
+
+        self.write('a', [1])
+        self.write('b', [2])
+        self.cat.mark_ready('a')
+        self.cat.mark_ready('b')
+        self.cat.claim_ready = claim_and_fail
+        try:
+            self.assertRaises(redis.ConnectionError, self.coalesced.run, 'C')
+        finally:
+            del self.cat.claim_ready
+            del self.redis.pipeline
+        self.assertEqual(self.redis.keys('C:*:lock'), [])
+        self.assertEqual(self.redis.hget('a:progress', 'C'), None)
+        self.assertEqual(sorted(self.ready()), ['a', 'b'])
+
+        self.seen = []
+        self.coalesced.run('C')
+        self.assertEqual(self.seen, [('a', 1), ('b', 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
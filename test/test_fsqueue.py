@@ -0,0 +1,198 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import msgpack
+
+from snowcat.utils import fsqueue
+
+
+class QueueIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.queue_dir = os.path.join(self.root, 'user', 'Stream', 'queue')
+        self.index = fsqueue.QueueIndex(self.queue_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def append(self, *chunks):
+        for chunk in chunks:
+            self.assertTrue(fsqueue.append_chunk(chunk, self.queue_dir))
+
+    def test_seek(self):
+        self.append([0, 1, 2], [], [3], [4, 5])
+
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.index.total_items(), 6)
+        self.assertEqual(self.index.seek(0), (1, 0))
+        self.assertEqual(self.index.seek(2), (1, 2))
+        self.assertEqual(self.index.seek(3), (3, 0))
+        self.assertEqual(self.index.seek(5), (4, 1))
+        self.assertIsNone(self.index.seek(6))
+
+    def test_seek_empty(self):
+        self.assertIsNone(self.index.seek(0))
+        self.append([])
+        self.assertIsNone(self.index.seek(0))
+
+    def test_rebuild(self):
+        self.append([0, 1], [2], [], [3, 4, 5])
+        with open(self.index.path, 'rb') as f:
+            expected = f.read()
+
+        os.remove(self.index.path)
+        with self.index.lock():
+            self.index.rebuild()
+        with open(self.index.path, 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_rebuild_atomic(self):
+        """ Readers never see a partially rebuilt index """
+        self.append([0, 1], [2])
+        with open(self.index.path, 'rb') as reader:
+            with self.index.lock():
+                self.index.rebuild()
+            self.assertEqual(len(reader.read()), 2 * self.index.RECORD.size)
+
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(
+            [n for n in os.listdir(os.path.dirname(self.index.path))
+             if n.endswith('.tmp')], [])
+
+    def test_missing_record(self):
+        """ A chunk written without its record (i.e. a crash in
+        append_chunk) is indexed at the next append.
+        """
+        self.append([0, 1], [2])
+        with open(fsqueue.chunk_path(self.queue_dir, 3), 'wb') as f:
+            f.write(msgpack.dumps([3, 4]))
+        self.append([5])
+
+        self.assertEqual([self.index.entry(i) for i in range(4)],
+                         [(0, 1, 2), (2, 2, 1), (3, 3, 2), (5, 4, 1)])
+        self.assertEqual(self.index.seek(4), (3, 1))
+        self.assertEqual(self.index.seek(5), (4, 0))
+
+    def test_partial_record(self):
+        self.append([0, 1], [2])
+        with open(self.index.path, 'ab') as f:
+            f.write(b'\0' * (self.index.RECORD.size // 2))
+        self.append([3])
+
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.seek(3), (3, 0))
+
+    def test_iter_items(self):
+        self.append([0, 1, 2], [], [3], [4, 5])
+        self.assertEqual(list(fsqueue.iter_items(self.queue_dir, 2)),
+                         [2, 3, 4, 5])
+
+
+class BufferedEmitterTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def queue_dir(self, queue):
+        return os.path.join(self.root, 'user', queue, 'queue')
+
+    def emitter(self, committed, chunk_size=3, fsync=False):
+        return fsqueue.BufferedEmitter(self.queue_dir, committed,
+                                       chunk_size=chunk_size, fsync=fsync)
+
+    def written(self, queue='Out'):
+        return list(fsqueue.iter_items(self.queue_dir(queue)))
+
+    def test_chunks(self):
+        committed = {}
+        emitter = self.emitter(committed)
+        for i in range(7):
+            emitter.emit('Out', i)
+
+        self.assertEqual(len(fsqueue.QueueIndex(self.queue_dir('Out'))), 2)
+        self.assertEqual(self.written(), range(6))
+        self.assertEqual(committed, {'Out': 6})
+        self.assertTrue(emitter.pending())
+
+        emitter.flush()
+        self.assertFalse(emitter.pending())
+        self.assertEqual(self.written(), range(7))
+        self.assertEqual(committed, {'Out': 7})
+
+    def test_queues(self):
+        committed = {}
+        emitter = self.emitter(committed)
+        emitter.emit('A', 1)
+        emitter.emit('B', 2)
+        emitter.emit('A', 3)
+        emitter.flush('A')
+        self.assertEqual(committed, {'A': 2})
+        emitter.flush()
+        self.assertEqual(committed, {'A': 2, 'B': 1})
+        self.assertEqual(self.written('A'), [1, 3])
+        self.assertEqual(self.written('B'), [2])
+
+    def test_fsync(self):
+        calls = []
+        fsync = fsqueue.os.fsync
+        fsqueue.os.fsync = calls.append
+        try:
+            emitter = self.emitter({})
+            emitter.emit('Out', 1)
+            emitter.flush()
+            self.assertEqual(calls, [])
+
+            emitter = self.emitter({}, fsync=True)
+            emitter.emit('Sync', 2)
+            emitter.flush()
+        finally:
+            fsqueue.os.fsync = fsync
+        self.assertEqual(len(calls), 2)  # the chunk and its index record
+
+    def test_restart(self):
+        """ Items written after the last saved state are emitted again
+        after a crash, and written only once.
+        """
+        committed = {}
+        emitter = self.emitter(committed)
+        for i in range(4):
+            emitter.emit('Out', i)
+        emitter.flush()
+        saved = dict(committed)  # the state is saved here
+
+        for i in range(4, 9):  # a chunk is flushed, then a crash
+            emitter.emit('Out', i)
+        self.assertEqual(self.written(), range(7))
+
+        committed = dict(saved)
+        emitter = self.emitter(committed)
+        for i in range(4, 12):
+            emitter.emit('Out', i)
+        emitter.flush()
+        self.assertEqual(self.written(), range(12))
+        self.assertEqual(committed, {'Out': 12})
+
+        # a later run doesn't skip anything
+        emitter = self.emitter(committed)
+        emitter.emit('Out', 12)
+        emitter.flush()
+        self.assertEqual(self.written(), range(13))
+
+    def test_flush_error(self):
+        committed = {}
+        queue_dir = self.queue_dir('Out')
+        os.makedirs(os.path.dirname(queue_dir))
+        open(queue_dir, 'w').close()  # not a directory
+        emitter = self.emitter(committed)
+        emitter.emit('Out', 1)
+        self.assertRaises(IOError, emitter.flush)
+        self.assertEqual(committed, {})
+        self.assertTrue(emitter.pending())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import os
+import unittest
+
+import redis
+
+from snowcat.utils import sharding
+from snowcat.utils.redis_utils import CounterMap, PersistentObject, PollValue, \
+    flush_all
+
+NODES = ['redis://a', 'redis://b', 'redis://c']
+
+# databases of a local redis used as nodes by the rebalancing test
+TEST_NODES = os.environ.get(
+    'SNOWCAT_TEST_REDIS_NODES',
+    'redis://localhost/13,redis://localhost/14,redis://localhost/15'
+).split(',')
+
+
+class HashRingTest(unittest.TestCase):
+    def test_stable(self):
+        a, b = sharding.HashRing(NODES), sharding.HashRing(list(NODES))
+        for i in range(1000):
+            self.assertEqual(a.node(i), b.node(str(i)))
+
+    def test_balanced(self):
+        ring = sharding.HashRing(NODES)
+        counts = dict((n, 0) for n in NODES)
+        for i in range(3000):
+            counts[ring.node(i)] += 1
+        for count in counts.itervalues():
+            self.assertTrue(700 < count < 1300, counts)
+
+    def test_add_node(self):
+        """ Adding a node only moves streams to the new node """
+        old = sharding.HashRing(NODES[:2])
+        new = sharding.HashRing(NODES)
+        moved = 0
+        for i in range(3000):
+            if old.node(i) != new.node(i):
+                self.assertEqual(new.node(i), 'redis://c')
+                moved += 1
+        self.assertTrue(700 < moved < 1300, moved)
+
+    def test_no_nodes(self):
+        self.assertRaises(ValueError, sharding.HashRing, [])
+
+
+class KeyStreamTest(unittest.TestCase):
+    PREFIXES = {'WordCounter', 'WordCount'}
+
+    def test_prefixed(self):
+        self.assertEqual(sharding.key_stream('WordCounter:42', self.PREFIXES),
+                         '42')
+        self.assertEqual(
+            sharding.key_stream('WordCounter:42:lock', self.PREFIXES), '42')
+        self.assertEqual(
+            sharding.key_stream('WordCount:42:CounterMap', self.PREFIXES),
+            '42')
+
+    def test_stream_keys(self):
+        self.assertEqual(sharding.key_stream('42:progress', self.PREFIXES),
+                         '42')
+        self.assertEqual(sharding.key_stream('42:SimpleKV', self.PREFIXES),
+                         '42')
+
+    def test_global(self):
+        self.assertIsNone(sharding.key_stream('snowcat_debug', self.PREFIXES))
+        self.assertIsNone(
+            sharding.key_stream('snowcat:activity', self.PREFIXES))
+        self.assertIsNone(sharding.key_stream('WordCounter', self.PREFIXES))
+        self.assertIsNone(sharding.key_stream('42', self.PREFIXES))
+
+    def test_rebalance_needs_prefixes(self):
+        self.assertRaises(ValueError, sharding.rebalance,
+                          NODES[:2], NODES, prefixes=())
+
+
+class RequireRedisTest(unittest.TestCase):
+    def tearDown(self):
+        sharding.configure()
+
+    def test_single_node(self):
+        sharding.configure()
+        self.assertIs(sharding.require_redis(None, 'x'), sharding.get_redis())
+
+    def test_many_nodes(self):
+        sharding.configure(NODES)
+        client = sharding.get_redis('42')
+        self.assertIs(sharding.require_redis(client, 'x'), client)
+        self.assertRaises(ValueError, PersistentObject, 'P:42')
+        self.assertRaises(ValueError, PollValue, '42:poll')
+        self.assertRaises(ValueError, CounterMap, 'WordCount:42')
+
+
+class RebalanceTest(unittest.TestCase):
+    """ Needs a local redis (see SNOWCAT_TEST_REDIS_NODES) """
+    def setUp(self):
+        self.clients = [redis.StrictRedis.from_url(n) for n in TEST_NODES]
+        try:
+            for r in self.clients:
+                r.flushdb()
+        except redis.ConnectionError:
+            self.skipTest('no redis server')
+
+    def tearDown(self):
+        for r in self.clients:
+            r.flushdb()
+
+    def test_rebalance(self):
+        old = sharding.ShardedRedis(TEST_NODES[:2])
+        streams = [str(i) for i in range(100)]
+        for auth_id in streams:
+            r = old.get(auth_id)
+            r.set('WordCounter:{0}'.format(auth_id), auth_id)
+            r.hset('{0}:progress'.format(auth_id), 'WordCounter', 1)
+            r.setex('WordCounter:{0}:lock'.format(auth_id), 100, 'x')
+        old.get().set('snowcat_debug', 1)
+
+        old_ring = sharding.HashRing(TEST_NODES[:2])
+        new_ring = sharding.HashRing(TEST_NODES)
+        expected = 3 * sum(1 for a in streams
+                           if old_ring.node(a) != new_ring.node(a))
+        self.assertEqual(sharding.rebalance(TEST_NODES[:2], TEST_NODES,
+                                            prefixes=['WordCounter'],
+                                            dry_run=True), expected)
+        self.assertEqual(sharding.rebalance(TEST_NODES[:2], TEST_NODES,
+                                            prefixes=['WordCounter']),
+                         expected)
+
+        new = sharding.ShardedRedis(TEST_NODES)
+        for auth_id in streams:
+            r = new.get(auth_id)
+            self.assertEqual(r.get('WordCounter:{0}'.format(auth_id)),
+                             auth_id)
+            self.assertEqual(r.hget('{0}:progress'.format(auth_id),
+                                    'WordCounter'), '1')
+            self.assertTrue(
+                0 < r.ttl('WordCounter:{0}:lock'.format(auth_id)) <= 100)
+        self.assertEqual(sum(r.dbsize() for r in self.clients),
+                         3 * len(streams) + 1)
+        self.assertEqual(new.get().get('snowcat_debug'), '1')
+
+    def test_flush_all(self):
+        """ Aggregates on different nodes are flushed to their own node """
+        counts = [CounterMap('WordCount:{0}'.format(i), redis_client=r)
+                  for i, r in enumerate(self.clients)]
+        for c in counts:
+            c.incr('word', 2)
+        flush_all(*counts)
+
+        for i, r in enumerate(self.clients):
+            self.assertEqual(r.keys('*'), ['WordCount:{0}'.format(i)])
+            self.assertEqual(r.hget('WordCount:{0}'.format(i), 'word'), '2')
+        self.assertFalse(any(c.pending() for c in counts))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import os
+import sqlite3
+import threading
+import unittest
+
+from snowcat.utils.statestore import SpillDict, SpillableObject, StateMissing
+
+from test.base import RedisTestCase
+
+
+def _connect():
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.execute('CREATE TABLE items (name TEXT, key BLOB, value BLOB, '
+                 'PRIMARY KEY (name, key))')
+    return conn
+
+
+class SpillDictTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = _connect()
+        self.d = SpillDict(self.conn, 'counts', max_items=3)
+
+    def stored(self):
+        return self.conn.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+    def test_spill(self):
+        for i in range(10):
+            self.d['w{0}'.format(i)] = i
+
+        self.assertEqual(len(self.d), 10)
+        self.assertEqual(len(self.d._hot), 3)
+        self.assertEqual(self.stored(), 7)
+        self.assertEqual(dict(self.d),
+                         dict(('w{0}'.format(i), i) for i in range(10)))
+        self.assertEqual(self.stored(), 10)
+
+    def test_update(self):
+        for i in range(10):
+            self.d[i] = 0
+        for i in range(10):
+            self.d[i] += i
+        self.assertEqual([self.d[i] for i in range(10)], range(10))
+        self.assertEqual(len(self.d), 10)
+
+    def test_mutable_values(self):
+        """ Mutable values read from the dict are written back """
+        self.d['a'] = [1]
+        self.d.flush()
+        self.d['a'].append(2)
+        for i in range(3):
+            self.d[i] = i  # evicts 'a'
+        self.assertNotIn('a', self.d._hot)
+        self.assertEqual(self.d['a'], [1, 2])
+
+    def test_delete(self):
+        for i in range(5):
+            self.d[i] = i
+        del self.d[0]  # spilled
+        del self.d[4]  # in memory
+        self.assertRaises(KeyError, self.d.__delitem__, 4)
+        self.assertNotIn(0, self.d)
+        self.assertNotIn(4, self.d)
+        self.assertEqual(len(self.d), 3)
+        self.assertEqual(sorted(self.d), [1, 2, 3])
+
+        self.d[0] = 'again'
+        self.assertEqual(self.d[0], 'again')
+        self.assertEqual(len(self.d), 4)
+
+    def test_clear(self):
+        for i in range(5):
+            self.d[i] = i
+        self.d.clear()
+        self.assertEqual(len(self.d), 0)
+        self.assertEqual(self.stored(), 0)
+        self.assertNotIn(0, self.d)
+
+    def test_threads(self):
+        def work(n):
+            for i in range(200):
+                key = '{0}:{1}'.format(n, i % 50)
+                self.d[key] = self.d.get(key, 0) + 1
+
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(self.d), 200)
+        self.assertEqual(set(self.d.values()), {4})
+
+
+class SpillableObjectTest(RedisTestCase):
+    def setUp(self):
+        super(SpillableObjectTest, self).setUp()
+        self.path = os.path.join(self.fs_prefix, 'u', 'state.db')
+
+    def state(self, max_items=2):
+        return SpillableObject('Cat:u', self.path,
+                               default={'idx': 0, 'counts': {'a': 1}},
+                               spill=('counts',), max_items=max_items)
+
+    def test_default(self):
+        s = self.state()
+        self.assertEqual(s.idx, 0)
+        self.assertEqual(dict(s.counts), {'a': 1})
+        self.assertIsInstance(s.counts, SpillDict)
+
+    def test_reload(self):
+        s = self.state()
+        for i in range(10):
+            s.counts['w{0}'.format(i)] = i
+        s.idx = 10
+        s.save()
+
+        s.counts['later'] = 1  # not saved
+        s.idx = 11
+
+        s = self.state()
+        self.assertEqual(s.idx, 10)
+        self.assertEqual(len(s.counts), 11)
+        self.assertNotIn('later', s.counts)
+        self.assertEqual(s.counts['w7'], 7)
+        self.assertEqual(s.counts['a'], 1)
+
+    def test_replace(self):
+        s = self.state()
+        counts = s.counts
+        s.counts = {'b': 2}
+        self.assertIs(s.counts, counts)
+        s.save()
+        self.assertEqual(dict(self.state().counts), {'b': 2})
+
+    def test_save_pipe(self):
+        s = self.state()
+        s.counts['b'] = 2
+        p = self.redis.pipeline()
+        s.save(p)
+        self.assertIsNone(self.redis.get(s._redis_ns))
+        p.execute()
+        self.assertEqual(dict(self.state().counts), {'a': 1, 'b': 2})
+
+    def test_missing(self):
+        """ A database older than the manifest is detected """
+        self.state().save()
+        os.remove(self.path)
+        self.assertRaises(StateMissing, self.state)
+
+    def test_delete(self):
+        s = self.state()
+        s.save()
+        s.delete()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertIsNone(self.redis.get(s._redis_ns))
+        self.assertEqual(dict(self.state().counts), {'a': 1})
+
+    def test_threads(self):
+        """ The state is saved by a thread while another one updates it """
+        s = self.state(max_items=10)
+        stop = threading.Event()
+
+        def save():
+            while not stop.is_set():
+                s.save()
+
+        saver = threading.Thread(target=save)
+        saver.start()
+        try:
+            for i in range(2000):
+                key = 'w{0}'.format(i % 100)
+                s.counts[key] = s.counts.get(key, 0) + 1
+        finally:
+            stop.set()
+            saver.join()
+        s.save()
+
+        s = self.state()
+        self.assertEqual(len(s.counts), 101)
+        self.assertEqual(s.counts['w42'], 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import time
+import unittest
+
+import redis
+
+from snowcat.tasks import FinalizeStream, STREAM_ACTIVITY_KEY
+from snowcat.utils import sharding
+
+from test.base import RedisTestCase
+from test.test_sharding import TEST_NODES
+
+
+class ReapIdleStreamsTest(RedisTestCase):
+    def setUp(self):
+        super(ReapIdleStreamsTest, self).setUp()
+        self.a = self.categorizer('A', process=lambda self, u, item: None)
+        # the copy of BaseStreamFinalizer made for this app by celery is not
+        # a FinalizeStream
+        self.app.tasks.register(type(FinalizeStream)(
+            'Finalizer', (FinalizeStream,),
+            dict(name='Finalizer', autoregister=False, _app=self.app)))
+        self.reaper = self.app.tasks['ReapIdleStreams']
+        self.reaper.FSQUEUE_PREFIX = self.fs_prefix
+        self.reaper.IDLE_TIMEOUT = 60
+
+    def stream(self, auth_id, last_activity):
+        self.write(auth_id, range(3))
+        self.a.run(auth_id)
+        sharding.get_redis().execute_command(
+            'ZADD', STREAM_ACTIVITY_KEY, last_activity, auth_id)
+
+    def keys(self, auth_id):
+        return sorted(self.redis.keys(self.a.gen_key(auth_id, '*')))
+
+    def test_idle(self):
+        self.stream('old', time.time() - 120)
+        self.stream('new', time.time())
+        self.assertEqual(self.reaper.run(), ['old'])
+
+        self.assertTrue(self.redis.get('old:finished'))
+        self.assertEqual(self.keys('old'), [])
+        self.assertFalse(os.path.exists(os.path.join(self.fs_prefix, 'old')))
+        self.assertEqual(self.redis.zrange(STREAM_ACTIVITY_KEY, 0, -1),
+                         ['new'])
+
+    def test_running(self):
+        """ Streams with a running categorizer are left alone """
+        self.stream('u', time.time() - 120)
+        self.redis.set(self.a.gen_key('u', 'lock'), 'run')
+        self.assertEqual(self.reaper.run(), [])
+
+        self.assertEqual(self.redis.get(self.a.gen_key('u', 'lock')), 'run')
+        self.assertFalse(self.redis.exists('u:finished'))
+        self.assertEqual(self.keys('u'), ['A:u:PersistentObject', 'A:u:lock'])
+        self.assertEqual(self.redis.zrange(STREAM_ACTIVITY_KEY, 0, -1),
+                         ['u'])
+
+    def test_no_run_while_reaping(self):
+        """ A run starting while the stream is reaped doesn't process it """
+        runs = []
+        cleanup = self.a.cleanup
+
+        def cleanup_and_run(auth_id):
+            cleanup(auth_id)
+            self.write(auth_id, range(3))
+            runs.append(self.a.run(auth_id))
+
+        self.stream('u', time.time() - 120)
+        self.a.cleanup = cleanup_and_run
+        try:
+            self.assertEqual(self.reaper.run(), ['u'])
+            runs.append(self.a.run('u'))
+        finally:
+            del self.a.cleanup
+        self.assertEqual(runs, [False, False])
+        self.assertEqual(self.keys('u'), [])
+
+
+class ReapOverBudgetTest(RedisTestCase):
+    """ Needs a local redis (see SNOWCAT_TEST_REDIS_NODES) """
+    def setUp(self):
+        super(ReapOverBudgetTest, self).setUp()
+        self.clients = sharding.configure(TEST_NODES).all()
+        try:
+            for r in self.clients:
+                r.flushdb()
+        except redis.ConnectionError:
+            self.skipTest('no redis server')
+
+        self.a = self.categorizer('A', process=lambda self, u, item: None)
+        self.reaper = self.app.tasks['ReapIdleStreams']
+        self.reaper.FSQUEUE_PREFIX = self.fs_prefix
+        self.reaper.MAX_REDIS_MEMORY = 1000
+        self.reaper.BATCH_SIZE = 2
+
+    def tearDown(self):
+        for r in self.clients:
+            r.flushdb()
+        super(ReapOverBudgetTest, self).tearDown()
+
+    def test_per_node(self):
+        """ Only the streams of the nodes over budget are reaped, least
+        recently active first
+        """
+        full = self.clients[1]
+        for r in self.clients:
+            r.info = lambda section, r=r: {
+                'used_memory': 2000 if r is full else 10}
+
+        streams = [str(i) for i in range(20)]
+        for i, auth_id in enumerate(streams):
+            self.write(auth_id, [i])
+            sharding.get_redis().execute_command(
+                'ZADD', STREAM_ACTIVITY_KEY, time.time() + i, auth_id)
+
+        on_full = [a for a in streams if sharding.get_redis(a) is full]
+        self.assertEqual(self.reaper.run(), on_full[:2])
+
+
+class SweepReadyTest(RedisTestCase):
+    def setUp(self):
+        super(SweepReadyTest, self).setUp()
+        self.cat = self.categorizer('C', COALESCE=10,
+                                    process=lambda self, u, item: None)
+        self.categorizer('NotCoalesced', process=lambda self, u, item: None)
+        self.scheduled = []
+        self.app.tasks['RunCoalesced'].apply_async = \
+            lambda args, countdown: self.scheduled.append(args)
+        self.sweep = self.app.tasks['SweepReady']
+
+    def test_sweep(self):
+        self.assertEqual(self.sweep.run(), [])
+
+        self.cat.mark_ready('u')
+        self.assertEqual(self.sweep.run(), [])  # a task is scheduled
+
+        # the task is lost, its flag expires
+        self.redis.delete('{0}:scheduled'.format(self.cat.ready_key()))
+        self.assertEqual(self.sweep.run(), ['C'])
+        self.assertEqual(self.scheduled, [('C',), ('C',)])
+
+
+if __name__ == '__main__':
+    unittest.main()